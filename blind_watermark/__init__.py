@@ -1,5 +1,6 @@
 from .blind_watermark import WaterMark
-from .bwm_core import WaterMarkCore
+from .bwm_core import WaterMarkCore, Decomposition
 from .att import *
 from .recover import recover_crop
+from .stats import StageStats
 from .version import __version__, bw_notes
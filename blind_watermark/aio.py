@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# coding=utf-8
+'''
+asyncio 接口：embed/extract 放到共享的进程池中计算，不阻塞事件循环。输入输出都是编码后的图片（bytes），不读写文件
+
+from blind_watermark import aio
+
+embed_bytes = await aio.embed(img_bytes, 'user1', mode='str', password_wm=1, password_img=1)
+wm = await aio.extract(embed_bytes, wm_shape=len_wm, mode='str', password_wm=1, password_img=1)
+
+同时在计算的任务不超过 max_concurrency 个，其余的在事件循环中排队。取消 await 中的任务时，还没开始计算的不再计算，
+已经在计算的会算完，但结果被丢弃，它在算完之前仍然占用一个名额
+aio.configure(processes=8, max_concurrency=16) 调整默认的进程池，web 服务退出时调用 aio.shutdown()
+'''
+import asyncio
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+from .blind_watermark import WaterMark
+from .version import bw_notes
+
+
+def embed_worker(data, wm, mode, format, compression_ratio, wm_kwargs):
+    # 在子进程中：解码 -> 嵌入 -> 编码
+    bwm = WaterMark(**wm_kwargs)
+    bwm.read_img(data=data)
+    bwm.read_wm(wm, mode=mode)
+    return bwm.embed(compression_ratio=compression_ratio, return_bytes=True, format=format)
+
+
+def extract_worker(data, wm_shape, mode, format, wm_kwargs):
+    # 在子进程中：解码 -> 提取。mode='img' 时返回编码后的水印图片
+    return WaterMark(**wm_kwargs).extract(data=data, wm_shape=wm_shape, mode=mode, return_bytes=True, format=format)
+
+
+class Engine:
+    '''
+    :param processes: 进程数，默认使用全部 CPU
+    :param max_concurrency: 同时提交到进程池的任务数，默认是进程数的 2 倍
+    一个 Engine 可以在多个事件循环中使用，每个事件循环各自限流
+    '''
+
+    def __init__(self, processes=None, max_concurrency=None):
+        processes = processes or multiprocessing.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=processes, initializer=bw_notes.close)
+        self.max_concurrency = max_concurrency or 2 * processes
+        self.semaphores = weakref.WeakKeyDictionary()  # 事件循环 -> asyncio.Semaphore
+
+    def semaphore(self, loop):
+        if loop not in self.semaphores:
+            self.semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphores[loop]
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphore(loop)
+        await semaphore.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        def release(_):
+            # 在进程池的线程中调用，任务完成、出错或被取消时才归还名额
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(semaphore.release)
+
+        future.add_done_callback(release)
+        # 取消 await 时 wrap_future 会一并取消 future，还没开始计算的任务不再计算
+        return await asyncio.wrap_future(future)
+
+    async def embed(self, data, wm, mode='str', format='.png', compression_ratio=None, **wm_kwargs):
+        '''
+        :param data: 原图，编码后的图片（bytes、bytearray 或 memoryview）
+        :param wm: 水印，与 WaterMark.read_wm(wm, mode=mode) 相同，mode 是 'str' 或 'bit'
+        :param format: 输出图片的格式，例如 '.png'、'.jpg'、'.webp'
+        :param wm_kwargs: WaterMark 的参数，例如 password_wm、password_img、block_size、resist，
+            mode 默认是 'vectorization'
+        :return: 打好水印的图片，bytes
+        '''
+        assert mode in ('str', 'bit'), "mode in ('str','bit')"
+        return await self.run(embed_worker, bytes(data), wm, mode, format, compression_ratio,
+                              dict({'mode': 'vectorization'}, **wm_kwargs))
+
+    async def extract(self, data, wm_shape, mode='str', format='.png', **wm_kwargs):
+        '''
+        :param data: 打好水印的图片，编码后的图片（bytes、bytearray 或 memoryview）
+        :param mode: 'str'、'bit'，或者 'img'（返回按 format 编码的水印图片）
+        :return: 与 WaterMark.extract 相同
+        '''
+        return await self.run(extract_worker, bytes(data), wm_shape, mode, format,
+                              dict({'mode': 'vectorization'}, **wm_kwargs))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+default_engine = None
+default_engine_lock = threading.Lock()
+
+
+def configure(processes=None, max_concurrency=None):
+    # 替换默认的进程池，旧的进程池等已提交的任务完成后关闭
+    global default_engine
+    with default_engine_lock:
+        old, default_engine = default_engine, Engine(processes=processes, max_concurrency=max_concurrency)
+    if old is not None:
+        old.executor.shutdown(wait=False)
+    return default_engine
+
+
+def get_engine():
+    global default_engine
+    with default_engine_lock:
+        if default_engine is None:
+            default_engine = Engine()
+        return default_engine
+
+
+async def embed(data, wm, mode='str', format='.png', compression_ratio=None, **wm_kwargs):
+    # 使用默认的进程池，参数见 Engine.embed
+    return await get_engine().embed(data, wm, mode=mode, format=format, compression_ratio=compression_ratio,
+                                    **wm_kwargs)
+
+
+async def extract(data, wm_shape, mode='str', format='.png', **wm_kwargs):
+    # 使用默认的进程池，参数见 Engine.extract
+    return await get_engine().extract(data, wm_shape, mode=mode, format=format, **wm_kwargs)
+
+
+def shutdown():
+    # 关闭默认的进程池，例如 web 服务退出时
+    global default_engine
+    with default_engine_lock:
+        engine, default_engine = default_engine, None
+    if engine is not None:
+        engine.close()
@@ -1,12 +1,30 @@
 # coding=utf-8
 
 # attack on the watermark
+# 所有攻击都可以：
+#   传入 out，结果直接写入 out，不再分配新的图片；out 的形状、类型要与结果相同
+#   随机的攻击传入 rng（seed 或 np.random.Generator），结果可复现；rng=None 时与以前一样使用全局的 np.random
+#   用 AttackChain 串起来，中间结果不写文件
 import cv2
 import numpy as np
 import warnings
 
 
-def cut_att3(input_filename=None, input_img=None, output_file_name=None, loc_r=None, loc=None, scale=None):
+def attack_rng(rng):
+    # rng=None 时用全局的 np.random，与以前的结果相同
+    return np.random if rng is None else np.random.default_rng(rng)
+
+
+def attack_out(input_img, out):
+    # 需要在原图上修改的攻击：out 为 None 时复制一份，否则把原图复制进 out（out 就是原图时原地修改）
+    if out is None:
+        return input_img.copy()
+    if out is not input_img:
+        np.copyto(out, input_img)
+    return out
+
+
+def cut_att3(input_filename=None, input_img=None, output_file_name=None, loc_r=None, loc=None, scale=None, out=None):
     # 剪切攻击 + 缩放攻击
     if input_filename:
         input_img = cv2.imread(input_filename)
@@ -17,15 +35,15 @@ def cut_att3(input_filename=None, input_img=None, output_file_name=None, loc_r=N
     else:
         x1, y1, x2, y2 = loc
 
-    # 剪切攻击
-    output_img = input_img[y1:y2, x1:x2].copy()
+    # 剪切攻击，缩放时直接从 view 缩放，不复制
+    output_img = input_img[y1:y2, x1:x2]
 
     # 如果缩放攻击
     if scale and scale != 1:
         h, w, _ = output_img.shape
-        output_img = cv2.resize(output_img, dsize=(round(w * scale), round(h * scale)))
+        output_img = cv2.resize(output_img, dsize=(round(w * scale), round(h * scale)), dst=out)
     else:
-        output_img = output_img
+        output_img = attack_out(output_img, out)
 
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
@@ -35,43 +53,46 @@ def cut_att3(input_filename=None, input_img=None, output_file_name=None, loc_r=N
 cut_att2 = cut_att3
 
 
-def resize_att(input_filename=None, input_img=None, output_file_name=None, out_shape=(500, 500)):
+def resize_att(input_filename=None, input_img=None, output_file_name=None, out_shape=(500, 500), out=None):
     # 缩放攻击：因为攻击和还原都是缩放，所以攻击和还原都调用这个函数
     if input_filename:
         input_img = cv2.imread(input_filename)
-    output_img = cv2.resize(input_img, dsize=out_shape)
+    output_img = cv2.resize(input_img, dsize=tuple(out_shape), dst=out)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def bright_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.8):
+def bright_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.8, out=None):
     # 亮度调整攻击，ratio应当多于0
     # ratio>1是调得更亮，ratio<1是亮度更暗
     if input_filename:
         input_img = cv2.imread(input_filename)
-    output_img = input_img * ratio
-    output_img[output_img > 255] = 255
+    if input_img.dtype == np.uint8:
+        # 乘法、取整、截断到 255 一步完成，不产生 float 的中间结果
+        output_img = cv2.convertScaleAbs(input_img, dst=out, alpha=ratio)
+    else:
+        output_img = np.multiply(input_img, ratio, out=out)
+        np.minimum(output_img, 255, out=output_img)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def shelter_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.1, n=3):
+def shelter_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.1, n=3, out=None, rng=None):
     # 遮挡攻击：遮挡图像中的一部分
     # n个遮挡块
     # 每个遮挡块所占比例为ratio
     if input_filename:
-        output_img = cv2.imread(input_filename)
-    else:
-        output_img = input_img.copy()
+        input_img = cv2.imread(input_filename)
+    output_img = attack_out(input_img, out)
     input_img_shape = output_img.shape
 
-    for i in range(n):
-        tmp = np.random.rand() * (1 - ratio)  # 随机选择一个地方，1-ratio是为了防止溢出
-        start_height, end_height = int(tmp * input_img_shape[0]), int((tmp + ratio) * input_img_shape[0])
-        tmp = np.random.rand() * (1 - ratio)
-        start_width, end_width = int(tmp * input_img_shape[1]), int((tmp + ratio) * input_img_shape[1])
+    # 随机选择 n 个地方，1-ratio是为了防止溢出。与逐个调用 rand() 的顺序相同：每个遮挡块先高度、后宽度
+    tmp = attack_rng(rng).random(size=(n, 2)) * (1 - ratio)
+    for tmp_height, tmp_width in tmp:
+        start_height, end_height = int(tmp_height * input_img_shape[0]), int((tmp_height + ratio) * input_img_shape[0])
+        start_width, end_width = int(tmp_width * input_img_shape[1]), int((tmp_width + ratio) * input_img_shape[1])
 
         output_img[start_height:end_height, start_width:end_width, :] = 255
 
@@ -80,34 +101,31 @@ def shelter_att(input_filename=None, input_img=None, output_file_name=None, rati
     return output_img
 
 
-def salt_pepper_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.01):
+def salt_pepper_att(input_filename=None, input_img=None, output_file_name=None, ratio=0.01, out=None, rng=None):
     # 椒盐攻击
     if input_filename:
         input_img = cv2.imread(input_filename)
-    input_img_shape = input_img.shape
-    output_img = input_img.copy()
-    for i in range(input_img_shape[0]):
-        for j in range(input_img_shape[1]):
-            if np.random.rand() < ratio:
-                output_img[i, j, :] = 255
+    output_img = attack_out(input_img, out)
+    # 每个像素一个随机数，按行依次生成，与逐个像素调用 rand() 的结果相同
+    output_img[attack_rng(rng).random(size=input_img.shape[:2]) < ratio] = 255
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def rot_att(input_filename=None, input_img=None, output_file_name=None, angle=45):
-    # 旋转攻击
+def rot_att(input_filename=None, input_img=None, output_file_name=None, angle=45, out=None):
+    # 旋转攻击，out 不能是 input_img
     if input_filename:
         input_img = cv2.imread(input_filename)
     rows, cols, _ = input_img.shape
     M = cv2.getRotationMatrix2D(center=(cols / 2, rows / 2), angle=angle, scale=1)
-    output_img = cv2.warpAffine(input_img, M, (cols, rows))
+    output_img = cv2.warpAffine(input_img, M, (cols, rows), dst=out)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def cut_att_height(input_filename=None, input_img=None, output_file_name=None, ratio=0.8):
+def cut_att_height(input_filename=None, input_img=None, output_file_name=None, ratio=0.8, out=None):
     warnings.warn('will be deprecated in the future, use att.cut_att2 instead')
     # 纵向剪切攻击
     if input_filename:
@@ -116,12 +134,14 @@ def cut_att_height(input_filename=None, input_img=None, output_file_name=None, r
     height = int(input_img_shape[0] * ratio)
 
     output_img = input_img[:height, :, :]
+    if out is not None:
+        output_img = attack_out(output_img, out)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def cut_att_width(input_filename=None, input_img=None, output_file_name=None, ratio=0.8):
+def cut_att_width(input_filename=None, input_img=None, output_file_name=None, ratio=0.8, out=None):
     warnings.warn('will be deprecated in the future, use att.cut_att2 instead')
     # 横向裁剪攻击
     if input_filename:
@@ -130,19 +150,22 @@ def cut_att_width(input_filename=None, input_img=None, output_file_name=None, ra
     width = int(input_img_shape[1] * ratio)
 
     output_img = input_img[:, :width, :]
+    if out is not None:
+        output_img = attack_out(output_img, out)
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
 
 
-def cut_att(input_filename=None, output_file_name=None, input_img=None, loc=((0.3, 0.1), (0.7, 0.9)), resize=0.6):
+def cut_att(input_filename=None, output_file_name=None, input_img=None, loc=((0.3, 0.1), (0.7, 0.9)), resize=0.6,
+            out=None):
     # warnings.warn('will be deprecated in the future, use att.cut_att2 instead')
     # 截屏攻击 = 裁剪攻击 + 缩放攻击 + 知道攻击参数（按照参数还原）
     # 裁剪攻击：其它部分都补0
     if input_filename:
         input_img = cv2.imread(input_filename)
 
-    output_img = input_img.copy()
+    output_img = attack_out(input_img, out)
     shape = output_img.shape
     x1, y1, x2, y2 = shape[0] * loc[0][0], shape[1] * loc[0][1], shape[0] * loc[1][0], shape[1] * loc[1][1]
     output_img[:int(x1), :] = 255
@@ -156,7 +179,7 @@ def cut_att(input_filename=None, output_file_name=None, input_img=None, loc=((0.
                                 dsize=(int(shape[1] * resize), int(shape[0] * resize))
                                 )
 
-        output_img = cv2.resize(output_img, dsize=(int(shape[1]), int(shape[0])))
+        output_img = cv2.resize(output_img, dsize=(int(shape[1]), int(shape[0])), dst=out)
 
     if output_file_name is not None:
         cv2.imwrite(output_file_name, output_img)
@@ -196,7 +219,7 @@ def anti_cut_att_old(input_filename, output_file_name, origin_shape):
     cv2.imwrite(output_file_name, output_img)
 
 
-def anti_cut_att(input_filename=None, input_img=None, output_file_name=None, origin_shape=None):
+def anti_cut_att(input_filename=None, input_img=None, output_file_name=None, origin_shape=None, out=None):
     warnings.warn('will be deprecated in the future, use att.cut_att2 instead')
     # 反裁剪攻击：补0
     # origin_shape 分辨率与约定理解的是颠倒的，约定的是列数*行数
@@ -220,6 +243,37 @@ def anti_cut_att(input_filename=None, input_img=None, output_file_name=None, ori
             [output_img, 255 * np.ones((output_img_shape[0], origin_shape[1] - output_img_shape[1], 3))]
             , axis=1)
 
+    if out is not None:
+        # 补边后是 float64，out 的类型不同时按 out 的类型写入
+        np.copyto(out, output_img, casting='unsafe')
+        output_img = out
     if output_file_name:
         cv2.imwrite(output_file_name, output_img)
     return output_img
+
+
+class AttackChain(object):
+    '''
+    把多个攻击串起来依次执行，中间结果都在内存中
+    chain = AttackChain(partial(rot_att, angle=45), partial(rot_att, angle=-45))
+    output_img = chain(input_img=img)
+    每一步都是 func(input_img=img) 返回攻击后的图片，att 中的函数用 functools.partial 给定参数
+    每一步都能 pickle 时 AttackChain 也能 pickle，可以直接作为 verify.Verifier 的攻击
+    '''
+
+    def __init__(self, *attacks):
+        self.attacks = attacks
+
+    def __call__(self, input_filename=None, input_img=None, output_file_name=None, out=None):
+        if input_filename:
+            input_img = cv2.imread(input_filename)
+        output_img = input_img
+        for i, attack in enumerate(self.attacks):
+            # 只有最后一步写入 out
+            if out is not None and i == len(self.attacks) - 1:
+                output_img = attack(input_img=output_img, out=out)
+            else:
+                output_img = attack(input_img=output_img)
+        if output_file_name:
+            cv2.imwrite(output_file_name, output_img)
+        return output_img
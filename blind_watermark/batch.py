@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# coding=utf-8
+'''
+批量打水印：按清单（manifest）把任务分配到进程池。同一张原图、同一组参数的任务按 chunk_size 个一批，每批只分解一次（embed_many）
+每完成一批就把结果追加写入日志（journal），中断后用同一个 journal 重新运行，已完成的任务会跳过
+
+jobs = [{'src': 'pic/a.png', 'target': 'output/a/user1.png', 'wm': 'user1', 'params': {'password_img': 1}}, ...]
+with BatchEmbedder(journal='output/journal.jsonl', processes=8) as embedder:
+    summary = embedder.run(jobs)
+
+任务是一个 dict：
+    src: 原图文件名
+    target: 输出文件名，也是任务的 id（可以用 'id' 另外指定）
+    wm: 水印，按 read_wm(wm, mode=wm_mode) 读入，wm_mode 默认是 'str'
+    params: WaterMark 的参数，例如 password_wm、password_img、block_size、resist、channels，mode 默认是 'vectorization'
+    compression_ratio: 与 WaterMark.embed 相同，可选
+清单也可以是 JSON Lines 文件，每行一个任务：embedder.run(read_manifest('manifest.jsonl'))
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .blind_watermark import WaterMark
+from .pool import AutoPool
+from .version import bw_notes
+
+
+def read_manifest(filename):
+    # JSON Lines 格式的清单，每行一个任务，忽略空行
+    with open(filename, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def job_id(job):
+    return job.get('id', job['target'])
+
+
+def read_journal(filename):
+    # 日志中已经完成的任务 id；崩溃时最后一行可能没写完，忽略无法解析的行
+    done = set()
+    if filename is None or not os.path.exists(filename):
+        return done
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') == 'done':
+                done.add(record['id'])
+            else:
+                done.discard(record['id'])
+    return done
+
+
+def open_journal(filename):
+    # 以追加方式打开日志。上次崩溃时最后一行可能没写完，先补一个换行，不与新的记录连在一起
+    partial = False
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        with open(filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            partial = f.read(1) != b'\n'
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    journal = open(filename, 'a', encoding='utf-8')
+    if partial:
+        journal.write('\n')
+    return journal
+
+
+def group_jobs(jobs):
+    # 按 (原图, 参数, 水印格式, 压缩率) 分组，每组再按 chunk_size 分成进程池中的任务
+    groups = OrderedDict()
+    for job in jobs:
+        key = (job['src'], json.dumps(job.get('params', {}), sort_keys=True), job.get('wm_mode', 'str'),
+               job.get('compression_ratio'))
+        groups.setdefault(key, []).append(job)
+    return [(src, json.loads(params), wm_mode, compression_ratio, group)
+            for (src, params, wm_mode, compression_ratio), group in groups.items()]
+
+
+# 每个进程（线程）最近读入的一张原图，同一组的下一批分到这里时不再重复读图和 dwt，只保留一张，不占用更多内存
+worker_state = threading.local()
+
+
+def read_src(src, params):
+    key = (src, json.dumps(params, sort_keys=True))
+    if getattr(worker_state, 'key', None) != key:
+        # 先释放上一张，再读入新的
+        worker_state.key, worker_state.bwm = None, None
+        bwm = WaterMark(**dict({'mode': 'vectorization'}, **params))
+        bwm.read_img(src)
+        worker_state.key, worker_state.bwm = key, bwm
+    return worker_state.bwm
+
+
+def embed_chunk(args):
+    # 在子进程中：读入原图（或复用上一批读入的），分解一次，嵌入这一批的全部水印
+    src, params, wm_mode, compression_ratio, jobs = args
+    bw_notes.close()
+    t = time.perf_counter()
+    error = None
+    try:
+        bwm = read_src(src, params)
+        for job in jobs:
+            os.makedirs(os.path.dirname(job['target']) or '.', exist_ok=True)
+        bwm.embed_many([job['wm'] for job in jobs], filenames=[job['target'] for job in jobs], mode=wm_mode,
+                       compression_ratio=compression_ratio)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    seconds = (time.perf_counter() - t) / len(jobs)
+    results = []
+    for job in jobs:
+        # 写入日志的 done 一定有输出文件，否则续跑时会被永远跳过
+        job_error = error or (None if os.path.exists(job['target']) else 'target not written')
+        results.append({'id': job_id(job), 'target': job['target'], 'status': 'failed' if job_error else 'done',
+                        'error': job_error, 'seconds': seconds})
+    return results
+
+
+class BatchEmbedder:
+    '''
+    :param journal: 日志文件名（JSON Lines，只追加），None 时不记录，也不能断点续跑
+    :param processes: 进程数，默认使用全部 CPU
+    :param mode: 'multiprocessing'，或者 'multithreading'/'common'
+    :param chunk_size: 进程池中一个任务（一次 embed_many）的水印数，每完成一个任务写一次日志
+    '''
+
+    def __init__(self, journal=None, processes=None, mode='multiprocessing', chunk_size=16):
+        self.journal = journal
+        self.chunk_size = chunk_size
+        self.pool = AutoPool(mode=mode, processes=processes)
+
+    def run(self, jobs, callback=None):
+        '''
+        :param jobs: 任务的列表，见模块说明
+        :param callback: 每完成一个任务调用一次 callback(result)，可用于打印进度
+            result: {'id', 'target', 'status', 'error', 'seconds'}，status 是 'done' 或 'failed'
+        :return: {'total', 'skipped', 'done', 'failed'}，failed 是失败任务的 result 列表
+        '''
+        jobs = list(jobs)
+        finished = read_journal(self.journal)
+        pending = [job for job in jobs if not (job_id(job) in finished and os.path.exists(job['target']))]
+        summary = {'total': len(jobs), 'skipped': len(jobs) - len(pending), 'done': 0, 'failed': []}
+
+        # 大的组先开始，各个进程的负载更均匀；同一组的各批相邻提交，多半分到刚读过这张原图的进程
+        tasks = []
+        for src, params, wm_mode, compression_ratio, group in sorted(group_jobs(pending),
+                                                                     key=lambda group: -len(group[-1])):
+            tasks.extend((src, params, wm_mode, compression_ratio, group[i:i + self.chunk_size])
+                         for i in range(0, len(group), self.chunk_size))
+
+        journal = None if self.journal is None else open_journal(self.journal)
+        try:
+            for results in self.pool.imap_unordered(embed_chunk, tasks):
+                for result in results:
+                    if result['status'] == 'done':
+                        summary['done'] += 1
+                    else:
+                        summary['failed'].append(result)
+                    if callback is not None:
+                        callback(result)
+                if journal is not None:
+                    journal.writelines(json.dumps(result) + '\n' for result in results)
+                    # 每批写完都落盘，进程被杀掉时最多丢失正在计算的几批
+                    journal.flush()
+                    os.fsync(journal.fileno())
+        finally:
+            if journal is not None:
+                journal.close()
+        return summary
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def run(jobs, journal=None, processes=None, callback=None):
+    # 只跑一次时的快捷方式
+    with BatchEmbedder(journal=journal, processes=processes) as embedder:
+        return embedder.run(jobs, callback=callback)
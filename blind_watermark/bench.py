@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# coding=utf-8
+'''
+性能测试：在合成图片上，对每种 mode、block_size、fast_mode 组合测量 embed/extract 的耗时、吞吐量、峰值内存和误码率
+结果输出为 JSON，便于对比不同版本
+
+blind_watermark_bench --sizes 512,1024x768 --modes common,vectorization --output bench.json
+python -m blind_watermark.bench --block-sizes 4 --repeat 3
+'''
+import json
+import platform
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+
+import numpy as np
+import cv2
+import pywt
+
+from .blind_watermark import WaterMark
+from .stats import StageStats
+from .version import __version__, bw_notes
+
+MODES = ('common', 'multithreading', 'multiprocessing', 'vectorization', 'cached')
+
+
+def synthesize_img(height, width, seed=0):
+    # 渐变 + 色块 + 噪声，既有平坦区域也有纹理，结果只由参数决定
+    rand = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([128 + 100 * np.sin(x / (17 + 13 * c) + y / (23 + 7 * c)) for c in range(3)], axis=2)
+    img[(x // 64 + y // 64) % 2 == 0] *= 0.7
+    img += rand.normal(0, 8, size=img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def peak_rss_mb():
+    # 当前进程的峰值内存，单位 MB，不支持的平台返回 None
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是 byte
+    return max_rss / (1 << 20) if sys.platform == 'darwin' else max_rss / (1 << 10)
+
+
+def run_case(case):
+    '''
+    跑一组参数，返回结果 dict
+    case: {'height', 'width', 'mode', 'block_size', 'fast_mode', 'svd_kernel', 'wm_bits', 'repeat'}
+    '''
+    bw_notes.close()
+    height, width, block_size = case['height'], case['width'], case['block_size']
+    result = dict(case)
+
+    capacity = (((height + 1) // 2) // block_size) * (((width + 1) // 2) // block_size)
+    if capacity <= case['wm_bits']:
+        result['skipped'] = 'image too small: {} blocks for {} bits'.format(capacity, case['wm_bits'])
+        return result
+
+    img = synthesize_img(height, width)
+    wm_bit = np.random.RandomState(1).randint(2, size=case['wm_bits']).astype(bool)
+
+    embed_times, extract_times = [], []
+    stats = StageStats()
+    for _ in range(case['repeat']):
+        bwm = WaterMark(password_wm=1, password_img=1, mode=case['mode'], block_size=block_size, stats=stats,
+                        svd_kernel=case['svd_kernel'])
+        bwm.bwm_core.fast_mode = case['fast_mode']
+        bwm.read_wm(wm_bit, mode='bit')
+        t = time.perf_counter()
+        bwm.read_img(img=img)
+        embed_img = bwm.embed()
+        embed_times.append(time.perf_counter() - t)
+
+        bwm = WaterMark(password_wm=1, password_img=1, mode=case['mode'], block_size=block_size, stats=stats,
+                        svd_kernel=case['svd_kernel'])
+        bwm.bwm_core.fast_mode = case['fast_mode']
+        t = time.perf_counter()
+        wm_extract = bwm.extract(embed_img=embed_img, wm_shape=wm_bit.size, mode='bit')
+        extract_times.append(time.perf_counter() - t)
+
+    megapixels = height * width / 1e6
+    result.update({
+        'embed_s': min(embed_times),
+        'extract_s': min(extract_times),
+        'embed_mps': megapixels / min(embed_times),
+        'extract_mps': megapixels / min(extract_times),
+        'psnr': cv2.PSNR(img, embed_img.clip(0, 255).astype(np.uint8)),
+        'ber': float(np.mean((wm_extract >= 0.5) != wm_bit)),
+        'peak_rss_mb': peak_rss_mb(),
+        # 每个阶段在全部 repeat 中的总耗时
+        'stage_seconds': {stage: item['seconds'] for stage, item in stats.summary().items()},
+    })
+    return result
+
+
+def run_case_subprocess(case):
+    # 每组参数单独起一个进程，峰值内存互不影响
+    proc = subprocess.run([sys.executable, '-m', 'blind_watermark.bench', '--case', json.dumps(case)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return dict(case, error=proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def parse_size(size):
+    # '1024' -> (1024, 1024), '1920x1080' -> (1080, 1920)
+    if 'x' in size:
+        width, height = size.split('x')
+        return int(height), int(width)
+    return int(size), int(size)
+
+
+def run(sizes=('512', '1024', '2048'), modes=MODES, block_sizes=(4, 8, 16), fast_modes=(False, True),
+        svd_kernels=('lapack',), wm_bits=64, repeat=1, in_process=False, callback=None):
+    '''
+    跑全部参数组合，返回可直接 json.dumps 的 dict
+    :param callback: 每跑完一组参数调用一次 callback(result)，可用于打印进度
+    '''
+    results = []
+    for size in sizes:
+        height, width = parse_size(size)
+        for mode in modes:
+            for block_size in block_sizes:
+                for fast_mode in fast_modes:
+                    for svd_kernel in svd_kernels:
+                        case = {'height': height, 'width': width, 'mode': mode, 'block_size': block_size,
+                                'fast_mode': fast_mode, 'svd_kernel': svd_kernel, 'wm_bits': wm_bits, 'repeat': repeat}
+                        result = run_case(case) if in_process else run_case_subprocess(case)
+                        results.append(result)
+                        if callback is not None:
+                            callback(result)
+
+    return {
+        'blind_watermark': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'pywt': pywt.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def format_result(result):
+    name = '{height}x{width} {mode:<15} bs={block_size:<2} fast={fast_mode:d} svd={svd_kernel:<6}'.format(**result)
+    if 'skipped' in result or 'error' in result:
+        return '{}  {}'.format(name, result.get('skipped') or result.get('error'))
+    return '{}  embed {embed_mps:7.2f} MP/s  extract {extract_mps:7.2f} MP/s  ber {ber:.4f}  rss {rss} MB' \
+        .format(name, rss=None if result['peak_rss_mb'] is None else round(result['peak_rss_mb']), **result)
+
+
+def main(argv=None):
+    opt_parser = OptionParser(usage='blind_watermark_bench [options]')
+    opt_parser.add_option('--sizes', default='512,1024,2048', help='image sizes, like 1024 or 1920x1080, comma separated')
+    opt_parser.add_option('--modes', default=','.join(MODES), help='modes, comma separated')
+    opt_parser.add_option('--block-sizes', default='4,8,16', help='block sizes, comma separated')
+    opt_parser.add_option('--fast-mode', default='0,1', help='fast_mode values, comma separated')
+    opt_parser.add_option('--svd-kernels', default='lapack', help='svd kernels, comma separated, like lapack,eig')
+    opt_parser.add_option('--wm-bits', type='int', default=64, help='watermark length in bits')
+    opt_parser.add_option('--repeat', type='int', default=1, help='repeat each case, report the fastest')
+    opt_parser.add_option('--in-process', action='store_true', default=False,
+                          help='run all cases in this process (faster, but peak RSS is shared)')
+    opt_parser.add_option('-o', '--output', help='write JSON to this file instead of stdout')
+    opt_parser.add_option('--case', help=SUPPRESS_HELP)
+    opts, _ = opt_parser.parse_args(argv)
+
+    if opts.case:
+        # run_case_subprocess 调用的子进程
+        print(json.dumps(run_case(json.loads(opts.case))))
+        return
+
+    report = run(sizes=opts.sizes.split(','),
+                 modes=opts.modes.split(','),
+                 block_sizes=[int(i) for i in opts.block_sizes.split(',')],
+                 fast_modes=[bool(int(i)) for i in opts.fast_mode.split(',')],
+                 svd_kernels=opts.svd_kernels.split(','),
+                 wm_bits=opts.wm_bits,
+                 repeat=opts.repeat,
+                 in_process=opts.in_process,
+                 callback=lambda result: print(format_result(result), file=sys.stderr))
+
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,89 +3,175 @@
 # @Time    : 2020/8/13
 # @Author  : github.com/guofei9987
 import warnings
+from functools import lru_cache
 
 import numpy as np
 import cv2
 
-from .bwm_core import WaterMarkCore
+from .bwm_core import WaterMarkCore, one_dim_kmeans
 from .version import bw_notes
 
 
 class WaterMark:
-    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None, resist=36, block_size=4):
+    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None, resist=36, block_size=4,
+                 strip_rows=None, shuffle_strategy='v1', stats=None, svd_kernel='lapack', channels='YUV'):
         bw_notes.print_notes()
 
-        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes, resist=resist, block_size=block_size)
+        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes, resist=resist, block_size=block_size,
+                                      strip_rows=strip_rows, shuffle_strategy=shuffle_strategy, stats=stats,
+                                      svd_kernel=svd_kernel, channels=channels)
 
         self.password_wm = password_wm
 
         self.wm_bit = None
         self.wm_size = 0
 
-    def read_img(self, filename=None, img=None):
-        if img is None:
+    def read_img(self, filename=None, img=None, data=None):
+        '''
+        :param data: bytes, bytearray or memoryview, an encoded image (like the content of a png/jpg file),
+            decoded in memory instead of reading a file
+        A np.memmap (or a filename ending with '.npy', opened as a read-only memmap) of shape (h, w, 3) or (h, w, 4)
+        is processed in strips, only a few rows are in memory at a time
+        '''
+        if img is None and data is not None:
+            with self.bwm_core.stage('imdecode'):
+                img = imdecode(data, flags=cv2.IMREAD_UNCHANGED)
+        elif img is None and is_npy(filename):
+            img = load_npy(filename)
+        elif img is None:
             # 从文件读入图片
-            img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
+            with self.bwm_core.stage('imread'):
+                img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
             assert img is not None, "image file '{filename}' not read".format(filename=filename)
 
         self.bwm_core.read_img_arr(img=img)
         return img
 
+    def decompose(self, filename=None, img=None, data=None):
+        '''
+        Decompose the image once (YUV, dwt, block dct), the result can be passed to extract as embed_img,
+        or to read_img as img, instead of the image. It is picklable.
+        '''
+        img = self.read_embed_img(filename=filename, embed_img=img, data=data)
+        return self.bwm_core.decompose(img)
+
+    def read_embed_img(self, filename=None, embed_img=None, data=None):
+        # extract/decompose 的输入：文件、编码后的 bytes，或者已经解码的图片
+        if data is not None:
+            with self.bwm_core.stage('imdecode'):
+                embed_img = imdecode(data, flags=cv2.IMREAD_COLOR)
+        elif is_npy(filename):
+            embed_img = load_npy(filename)[:, :, :3]
+        elif filename is not None:
+            with self.bwm_core.stage('imread'):
+                embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
+            assert embed_img is not None, "{filename} not read".format(filename=filename)
+        return embed_img
+
     def read_wm(self, wm_content, mode='img'):
+        self.wm_bit = self.wm_to_bit(wm_content, mode=mode)
+        self.wm_size = self.wm_bit.size
+        self.bwm_core.read_wm(self.wm_bit)
+
+    def wm_to_bit(self, wm_content, mode='img'):
         assert mode in ('img', 'str', 'bit'), "mode in ('img','str','bit')"
         if mode == 'img':
             wm = cv2.imread(filename=wm_content, flags=cv2.IMREAD_GRAYSCALE)
             assert wm is not None, 'file "{filename}" not read'.format(filename=wm_content)
 
             # 读入图片格式的水印，并转为一维 bit 格式，抛弃灰度级别
-            self.wm_bit = wm.flatten() > 128
+            wm_bit = wm.flatten() > 128
 
         elif mode == 'str':
             byte = bin(int(wm_content.encode('utf-8').hex(), base=16))[2:]
-            self.wm_bit = (np.array(list(byte)) == '1')
+            wm_bit = (np.array(list(byte)) == '1')
         else:
-            self.wm_bit = np.array(wm_content)
-
-        self.wm_size = self.wm_bit.size
+            wm_bit = np.array(wm_content)
 
         # 水印加密:
-        np.random.RandomState(self.password_wm).shuffle(self.wm_bit)
+        np.random.RandomState(self.password_wm).shuffle(wm_bit)
+        return wm_bit
 
-        self.bwm_core.read_wm(self.wm_bit)
-
-    def embed(self, filename=None, compression_ratio=None):
+    def embed(self, filename=None, compression_ratio=None, return_bytes=False, format='.png', out=None):
         '''
         :param filename: string
             Save the image file as filename
         :param compression_ratio: int or None
             If compression_ratio = None, do not compression,
             If compression_ratio is integer between 0 and 100, the smaller, the output file is smaller.
+        :param return_bytes: bool
+            Return the image encoded in memory as format, like '.png', '.jpg' or '.webp', instead of the array
+        :param out: np.memmap, array or filename ending with '.npy'
+            Write the image into out (uint8 is rounded like the image file), each strip is written as soon as
+            it is embedded. A filename is created as a uint8 .npy memmap of shape (h, w, 3) or (h, w, 4)
         :return:
         '''
-        embed_img = self.bwm_core.embed()
+        if isinstance(out, str):
+            out = open_npy(out, self.bwm_core.img_shape, 3 if self.bwm_core.alpha is None else 4)
+        embed_img = self.bwm_core.embed(out=out)
         if filename is not None:
-            if compression_ratio is None:
-                cv2.imwrite(filename=filename, img=embed_img)
-            elif filename.endswith('.jpg'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
-            elif filename.endswith('.png'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
-            else:
-                cv2.imwrite(filename=filename, img=embed_img)
+            self.write_img(filename, embed_img, compression_ratio)
+        if return_bytes:
+            with self.bwm_core.stage('imencode'):
+                return imencode(embed_img, format=format, compression_ratio=compression_ratio)
         return embed_img
 
+    def embed_many(self, payloads, filenames=None, mode='str', compression_ratio=None, return_bytes=False,
+                   format='.png'):
+        '''
+        Embed each of payloads into the image read by read_img, the image is decomposed only once.
+        :param payloads: list
+            Watermarks, each one is read like read_wm(payload, mode=mode)
+        :param filenames: list of string or None
+            Save the i-th image file as filenames[i]
+        :param mode: 'img', 'str' or 'bit'
+        :param compression_ratio: int or None, same as embed
+        :param return_bytes: bool, same as embed, filenames are ignored
+        :return: list of embedded images if filenames is None, else filenames
+        '''
+        wm_bits = [self.wm_to_bit(payload, mode=mode) for payload in payloads]
+        embed_imgs = self.bwm_core.embed_many(wm_bits)
+        if return_bytes:
+            with self.bwm_core.stage('imencode'):
+                return [imencode(embed_img, format=format, compression_ratio=compression_ratio)
+                        for embed_img in embed_imgs]
+        if filenames is None:
+            return list(embed_imgs)
+
+        assert len(filenames) == len(payloads), 'one filename for each payload'
+        for filename, embed_img in zip(filenames, embed_imgs):
+            self.write_img(filename, embed_img, compression_ratio)
+        return filenames
+
+    def write_img(self, filename, embed_img, compression_ratio=None):
+        with self.bwm_core.stage('imwrite'):
+            self.imwrite(filename, embed_img, compression_ratio)
+
+    def imwrite(self, filename, embed_img, compression_ratio=None):
+        if compression_ratio is None:
+            ok = cv2.imwrite(filename=filename, img=embed_img)
+        elif filename.endswith('.jpg'):
+            ok = cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
+        elif filename.endswith('.png'):
+            ok = cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
+        else:
+            ok = cv2.imwrite(filename=filename, img=embed_img)
+        # 路径不可写等情况下 cv2.imwrite 只返回 False，不报错
+        assert ok, "image file '{filename}' not written".format(filename=filename)
+
     def extract_decrypt(self, wm_avg):
-        wm_index = np.arange(self.wm_size)
-        np.random.RandomState(self.password_wm).shuffle(wm_index)
-        wm_avg[wm_index] = wm_avg.copy()
+        wm_avg[wm_permutation(self.password_wm, self.wm_size)] = wm_avg.copy()
         return wm_avg
 
-    def extract(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img'):
+    def extract(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img', data=None,
+                return_bytes=False, format='.png'):
+        '''
+        :param data: bytes, bytearray or memoryview, an encoded image, instead of filename or embed_img
+        :param return_bytes: bool, only for mode='img', return the watermark image encoded as format
+        '''
         assert wm_shape is not None, 'wm_shape needed'
 
-        if filename is not None:
-            embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
-            assert embed_img is not None, "{filename} not read".format(filename=filename)
+        embed_img = self.read_embed_img(filename=filename, embed_img=embed_img, data=data)
 
         self.wm_size = np.array(wm_shape).prod()
 
@@ -97,12 +183,97 @@ class WaterMark:
         # 解密：
         wm = self.extract_decrypt(wm_avg=wm_avg)
 
-        # 转化为指定格式：
+        return self.wm_format(wm, wm_shape=wm_shape, out_wm_name=out_wm_name, mode=mode,
+                              format=format if return_bytes else None)
+
+    def extract_stream(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img',
+                       margin=0.05, delta=1e-3, data=None, return_bytes=False, format='.png'):
+        '''
+        与 extract 相同，但按随机顺序分批提取分块，所有 bit 都足够确定后就停止，大图上通常只需要读取一小部分分块
+        :return: (wm, confidence)，confidence 与 wm 一一对应，含义见 WaterMarkCore.extract_stream
+        '''
+        assert wm_shape is not None, 'wm_shape needed'
+
+        embed_img = self.read_embed_img(filename=filename, embed_img=embed_img, data=data)
+
+        self.wm_size = np.array(wm_shape).prod()
+
+        wm_avg, confidence = self.bwm_core.extract_stream(img=embed_img, wm_shape=wm_shape, margin=margin, delta=delta)
+        if mode in ('str', 'bit'):
+            wm_avg = one_dim_kmeans(wm_avg)
+
+        wm = self.extract_decrypt(wm_avg=wm_avg)
+        confidence = self.extract_decrypt(wm_avg=confidence)
+
+        wm = self.wm_format(wm, wm_shape=wm_shape, out_wm_name=out_wm_name, mode=mode,
+                            format=format if return_bytes else None)
+        return wm, confidence
+
+    def wm_format(self, wm, wm_shape, out_wm_name=None, mode='img', format=None):
+        # 转化为指定格式，mode='img' 且指定了 format 时返回编码后的水印图片
         if mode == 'img':
             wm = 255 * wm.reshape(wm_shape[0], wm_shape[1])
-            cv2.imwrite(out_wm_name, wm)
+            if out_wm_name is not None:
+                cv2.imwrite(out_wm_name, wm)
+            if format is not None:
+                return imencode(wm, format=format)
         elif mode == 'str':
             byte = ''.join(str((i >= 0.5) * 1) for i in wm)
             wm = bytes.fromhex(hex(int(byte, base=2))[2:]).decode('utf-8', errors='replace')
 
         return wm
+
+
+# 各种格式的 compression_ratio 对应的参数，与 WaterMark.imwrite 一致
+IMWRITE_PARAMS = {
+    '.jpg': cv2.IMWRITE_JPEG_QUALITY,
+    '.jpeg': cv2.IMWRITE_JPEG_QUALITY,
+    '.png': cv2.IMWRITE_PNG_COMPRESSION,
+    '.webp': cv2.IMWRITE_WEBP_QUALITY,
+}
+
+
+def is_npy(filename):
+    return isinstance(filename, str) and filename.lower().endswith('.npy')
+
+
+def load_npy(filename):
+    # 原始像素的 .npy 文件，以只读的 memmap 打开，不读入内存
+    img = np.load(filename, mmap_mode='r')
+    assert img.ndim == 3 and img.shape[2] in (3, 4), \
+        "'{filename}' should be of shape (h, w, 3) or (h, w, 4), got {shape}".format(filename=filename,
+                                                                                    shape=img.shape)
+    return img
+
+
+def open_npy(filename, img_shape, n_channels):
+    # 预先分配输出的 .npy 文件，embed 时逐条写入
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8,
+                                     shape=tuple(img_shape) + (n_channels,))
+
+
+def imdecode(data, flags=cv2.IMREAD_UNCHANGED):
+    # 在内存中解码图片，data 是 bytes、bytearray 或 memoryview
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    assert img is not None, 'image data not decoded'
+    return img
+
+
+def imencode(img, format='.png', compression_ratio=None):
+    # 在内存中编码图片，与 cv2.imwrite 相同：四舍五入，截断到 0~255
+    params = []
+    if compression_ratio is not None and format in IMWRITE_PARAMS:
+        params = [IMWRITE_PARAMS[format], compression_ratio]
+    img = np.clip(np.round(img), 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode(format, img, params)
+    assert ok, 'image not encoded as {}'.format(format)
+    return buf.tobytes()
+
+
+@lru_cache(maxsize=64)
+def wm_permutation(password_wm, wm_size):
+    # 与 wm_to_bit 中 RandomState(password_wm).shuffle 相同的置换，同一个水印长度反复解密时只算一次
+    wm_index = np.arange(wm_size)
+    np.random.RandomState(password_wm).shuffle(wm_index)
+    wm_index.flags.writeable = False
+    return wm_index
@@ -3,16 +3,21 @@
 # @Time    : 2021/12/17
 # @Author  : github.com/guofei9987
 import numpy as np
-from numpy.linalg import svd
-import copy
+from contextlib import contextmanager
 import cv2
-from cv2 import dct, idct
 from pywt import dwt2, idwt2
-from .pool import AutoPool
+from .pool import AutoPool, SharedArray
+from .cache import decomposition_cache, img_hash
+from .shuffle import ShuffleStream, shuffle_provider
+from .kernel import SVD_KERNELS, dct_blocks
+
+# 读入 np.memmap 且没有指定 strip_rows 时，按这个行数分条处理，不把整张图读进内存
+MEMMAP_STRIP_ROWS = 1024
 
 
 class WaterMarkCore:
-    def __init__(self, password_img=1, mode='common', processes=None, resist=36, block_size=4):
+    def __init__(self, password_img=1, mode='common', processes=None, resist=36, block_size=4, strip_rows=None,
+                 shuffle_strategy='v1', stats=None, svd_kernel='lapack', channels='YUV'):
         self.block_shape = np.array([block_size, block_size])
         self.password_img = password_img
         self.d1, self.d2 = resist, 20  # d1/d2 越大鲁棒性越强,但输出图片的失真越大
@@ -20,14 +25,34 @@ class WaterMarkCore:
         # init data
         self.img, self.img_YUV = None, None  # self.img 是原图，self.img_YUV 对像素做了加白偶数化
         self.ca, self.hvd, = [np.array([])] * 3, [np.array([])] * 3  # 每个通道 dct 的结果
-        self.ca_block = [np.array([])] * 3  # 每个 channel 存一个四维 array，代表四维分块后的结果
-        self.ca_part = [np.array([])] * 3  # 四维分块后，有时因不整除而少一部分，self.ca_part 是少这一部分的 self.ca
+        self.ca_block = [np.array([])] * 3  # 每个 channel 存一个四维 array，代表四维分块后的结果，是 self.ca 的只读 view
+        self.block_dct = [None] * 3  # 读入 Decomposition 时，每个分块的 dct 已经算好，提取时直接使用
+        self.img_key = None  # mode='cached' 时缓存的 key
 
         self.wm_size, self.block_num = 0, 0  # 水印的长度，原图片可插入信息的个数
         self.pool = AutoPool(mode=mode, processes=processes)
 
         self.fast_mode = False
         self.alpha = None  # 用于处理透明图
+        self.strip_rows = strip_rows  # 不为 None 时，按每条 strip_rows 行分条处理大图，限制内存占用
+        self.strip_rows_auto = False  # strip_rows 是否因为读入 np.memmap 而自动设置
+        self.shuffle_strategy = shuffle_strategy  # 分块加密的置换策略，见 shuffle.py，嵌入和提取必须相同
+        self.stats = stats  # StageStats，记录每个阶段的耗时和内存分配，见 stats.py
+        # 'lapack' 是 np.linalg.svd；'eig' 用 BᵀB 的特征分解，对小分块更快，见 kernel.py
+        assert svd_kernel in SVD_KERNELS, 'svd_kernel in {}'.format(tuple(SVD_KERNELS))
+        self.svd_kernel, self.svd = svd_kernel, SVD_KERNELS[svd_kernel]
+        # 嵌入/提取用到的 YUV 通道，例如 ('Y',)；其余通道不做 dwt 和分块计算，嵌入和提取必须相同
+        self.channels = parse_channels(channels)
+
+    def __getstate__(self):
+        # 没有共享内存时，multiprocessing 模式的 pool.map 会 pickle 绑定方法（连同 self）；进程池和计时在子进程中用不到
+        state = self.__dict__.copy()
+        state['pool'], state['stats'] = None, None
+        return state
+
+    def stage(self, name):
+        # 在 with 块中运行的代码记为一个阶段，self.stats 为 None 时什么都不做
+        return self.stats.stage(name) if self.stats is not None else no_stage()
 
     def init_block_index(self):
         self.block_num = self.ca_block_shape[0] * self.ca_block_shape[1]
@@ -35,9 +60,56 @@ class WaterMarkCore:
             '最多可嵌入{}kb信息，多于水印的{}kb信息，溢出'.format(self.block_num / 1000, self.wm_size / 1000))
         # self.part_shape 是取整后的ca二维大小,用于嵌入时忽略右边和下面对不齐的细条部分。
         self.part_shape = self.ca_block_shape[:2] * self.block_shape
-        self.block_index = [(i, j) for i in range(self.ca_block_shape[0]) for j in range(self.ca_block_shape[1])]
+
+    def get_idx_shuffle(self):
+        # 每个分块加密用的置换，(block_num, bs*bs)，相同参数的结果会被缓存
+        with self.stage('shuffle'):
+            return shuffle_provider.get(self.password_img, self.block_num, self.block_shape[0] * self.block_shape[1],
+                                        self.shuffle_strategy)
+
+    def reset_strip_rows(self):
+        if self.strip_rows_auto:
+            # 上一张是 np.memmap 时自动设置的 strip_rows，不影响这一张
+            self.strip_rows, self.strip_rows_auto = None, False
+
+    def whole_img(self, img):
+        # decompose/extract_stream 需要整张图的分解结果，不能分条：np.memmap 在这里整张读入内存
+        self.reset_strip_rows()
+        if isinstance(img, np.memmap):
+            with self.stage('read_memmap'):
+                img = np.array(img)
+        return img
 
     def read_img_arr(self, img):
+        self.reset_strip_rows()
+        if isinstance(img, Decomposition):
+            return self.load_decomposition(img)
+
+        self.block_dct = [None] * 3
+        if self.strip_rows is None and isinstance(img, np.memmap):
+            self.strip_rows, self.strip_rows_auto = MEMMAP_STRIP_ROWS, True
+        if self.strip_rows is not None:
+            # 分条处理时只记录原图，embed/extract 时再逐条读入；原图是 np.memmap 时，每次只从文件读入一条
+            self.alpha = None
+            if img.shape[2] == 4:
+                if img[:, :, 3].min() < 255:
+                    self.alpha = img[:, :, 3]
+                    img = img[:, :, :3]
+            self.img = img
+            self.img_shape = img.shape[:2]
+            self.ca_shape = [(i + 1) // 2 for i in self.img_shape]
+            self.ca_block_shape = (self.ca_shape[0] // self.block_shape[0], self.ca_shape[1] // self.block_shape[1],
+                                   self.block_shape[0], self.block_shape[1])
+            return
+
+        if self.pool.mode == 'cached':
+            # 同一张图片只做一次 YUV化、dwt 和分块
+            with self.stage('cache_lookup'):
+                self.img_key = (img_hash(img), tuple(self.block_shape), self.channels)
+                cached = decomposition_cache.get(self.img_key)
+            if cached is not None:
+                return self.load_decomposition(cached)
+
         # 处理透明图
         self.alpha = None
         if img.shape[2] == 4:
@@ -46,25 +118,70 @@ class WaterMarkCore:
                 img = img[:, :, :3]
 
         # 读入图片->YUV化->加白边使像素变偶数->四维分块
-        self.img = img.astype(np.float32)
-        self.img_shape = self.img.shape[:2]
+        with self.stage('to_yuv'):
+            self.img = img.astype(np.float32)
+            self.img_shape = self.img.shape[:2]
 
-        # 如果不是偶数，那么补上白边，Y（明亮度）UV（颜色）
-        self.img_YUV = cv2.copyMakeBorder(cv2.cvtColor(self.img, cv2.COLOR_BGR2YUV),
-                                          0, self.img.shape[0] % 2, 0, self.img.shape[1] % 2,
-                                          cv2.BORDER_CONSTANT, value=(0, 0, 0))
+            # 如果不是偶数，那么补上白边，Y（明亮度）UV（颜色）
+            self.img_YUV = cv2.copyMakeBorder(cv2.cvtColor(self.img, cv2.COLOR_BGR2YUV),
+                                              0, self.img.shape[0] % 2, 0, self.img.shape[1] % 2,
+                                              cv2.BORDER_CONSTANT, value=(0, 0, 0))
 
         self.ca_shape = [(i + 1) // 2 for i in self.img_shape]
 
         self.ca_block_shape = (self.ca_shape[0] // self.block_shape[0], self.ca_shape[1] // self.block_shape[1],
                                self.block_shape[0], self.block_shape[1])
-        strides = 4 * np.array([self.ca_shape[1] * self.block_shape[0], self.block_shape[1], self.ca_shape[1], 1])
 
-        for channel in range(3):
-            self.ca[channel], self.hvd[channel] = dwt2(self.img_YUV[:, :, channel], 'haar')
-            # 转为4维度
-            self.ca_block[channel] = np.lib.stride_tricks.as_strided(self.ca[channel].astype(np.float32),
-                                                                     self.ca_block_shape, strides)
+        self.ca, self.hvd, self.ca_block = [np.array([])] * 3, [np.array([])] * 3, [np.array([])] * 3
+        for channel in self.channels:
+            with self.stage('dwt'):
+                self.ca[channel], self.hvd[channel] = dwt2(self.img_YUV[:, :, channel], 'haar')
+                # 转为4维度
+                self.ca_block[channel] = block_view(self.ca[channel], self.ca_block_shape)
+
+        if self.pool.mode == 'cached':
+            # 用到全部通道时 ca_to_img 不需要 img_YUV，不放进缓存
+            decomposition_cache.put(self.img_key, self.get_decomposition(with_yuv=len(self.channels) < 3))
+        else:
+            self.img_key = None
+
+    def get_decomposition(self, with_yuv=True, with_dct=False):
+        # 把 read_img_arr 的结果打包成 Decomposition
+        block_dct = None
+        if with_dct:
+            with self.stage('dct'):
+                block_dct = [dct_blocks(self.ca_block[channel]) if channel in self.channels else None
+                             for channel in range(3)]
+        return Decomposition(alpha=self.alpha, img_shape=self.img_shape, ca_shape=self.ca_shape,
+                             ca_block_shape=self.ca_block_shape, channels=self.channels,
+                             img_YUV=self.img_YUV if with_yuv else None, ca=list(self.ca), hvd=list(self.hvd),
+                             block_dct=block_dct, key=self.img_key)
+
+    def load_decomposition(self, decomposition):
+        # 与 read_img_arr 的结果相同，但 YUV化、dwt 已经做过
+        assert self.strip_rows is None, 'strip_rows does not support Decomposition'
+        assert decomposition.ca_block_shape[2:] == tuple(self.block_shape), 'block_size of Decomposition not match'
+        assert set(self.channels) <= set(decomposition.channels), 'channels of Decomposition not match'
+        self.alpha, self.img_shape, self.ca_shape, self.ca_block_shape = \
+            decomposition.alpha, decomposition.img_shape, decomposition.ca_shape, decomposition.ca_block_shape
+        self.img_YUV, self.img_key = decomposition.img_YUV, decomposition.key
+        self.ca, self.hvd = list(decomposition.ca), list(decomposition.hvd)
+        self.block_dct = list(decomposition.block_dct) if decomposition.block_dct is not None else [None] * 3
+        for channel in self.channels:
+            self.ca_block[channel] = block_view(self.ca[channel], self.ca_block_shape)
+
+    def decompose(self, img):
+        '''
+        对 img 做 YUV化、dwt 和分块 dct，返回 Decomposition
+        它可以 pickle，也可以代替图片传给 extract，例如打水印后在内存中多次提取时，不再需要写文件、读文件和重复的变换
+        '''
+        img = self.whole_img(img)
+        assert self.strip_rows is None, 'strip_rows does not support Decomposition'
+        self.read_img_arr(img=img)
+        if self.img_YUV is None:
+            # 来自 mode='cached' 的缓存，缓存中没有 YUV 图
+            return self.get_decomposition(with_yuv=False, with_dct=True)
+        return self.get_decomposition(with_dct=True)
 
     def read_wm(self, wm_bit):
         self.wm_bit = wm_bit
@@ -77,66 +194,294 @@ class WaterMarkCore:
             return self.block_add_wm_slow(arg)
 
     def block_add_wm_slow(self, arg):
-        block, shuffler, i = arg
-        # dct->(flatten->加密->逆flatten)->svd->打水印->逆svd->(flatten->解密->逆flatten)->逆dct
+        block_dct, shuffler, i = arg
+        # (flatten->加密->逆flatten)->svd->打水印->逆svd->(flatten->解密->逆flatten)
+        # 分块的 dct/idct 在 block_add_wm_4d 中批量完成
         wm_1 = self.wm_bit[i % self.wm_size]
-        block_dct = dct(block)
 
         # 加密（打乱顺序）
         block_dct_shuffled = block_dct.flatten()[shuffler].reshape(self.block_shape)
-        u, s, v = svd(block_dct_shuffled)
+        u, s, v = self.svd(block_dct_shuffled)
         s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
         if self.d2:
             s[1] = (s[1] // self.d2 + 1 / 4 + 1 / 2 * wm_1) * self.d2
 
         block_dct_flatten = np.dot(u, np.dot(np.diag(s), v)).flatten()
         block_dct_flatten[shuffler] = block_dct_flatten.copy()
-        return idct(block_dct_flatten.reshape(self.block_shape))
+        return block_dct_flatten.reshape(self.block_shape)
 
     def block_add_wm_fast(self, arg):
-        # dct->svd->打水印->逆svd->逆dct
-        block, shuffler, i = arg
+        # svd->打水印->逆svd
+        block_dct, shuffler, i = arg
         wm_1 = self.wm_bit[i % self.wm_size]
 
-        u, s, v = svd(dct(block))
+        u, s, v = self.svd(block_dct)
         s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
 
-        return idct(np.dot(u, np.dot(np.diag(s), v)))
+        return np.dot(u, np.dot(np.diag(s), v))
+
+    def block_svd_vec(self, blocks, shuffler):
+        # 一次处理全部分块：dct->(flatten->加密->逆flatten)->svd
+        # blocks 是 (n, bs, bs) 或四维的 (rows, cols, bs, bs)，返回的 u、s、v 都按 n 个分块排列
+        block_dct = dct_blocks(blocks).reshape(-1, *self.block_shape)
+        if self.fast_mode:
+            return self.svd(block_dct)
+
+        block_dct_shuffled = np.take_along_axis(block_dct.reshape(block_dct.shape[0], -1), shuffler, axis=1) \
+            .reshape(block_dct.shape)
+        return self.svd(block_dct_shuffled)
+
+    def block_add_wm_s(self, s, wm_bits):
+        # 打水印，只修改奇异值。s 的最后一维是每个分块的奇异值，前面的维度按 wm_bits 广播，
+        # 例如 s.shape=(block_num, k)、wm_bits.shape=(N, block_num) 时返回 (N, block_num, k)
+        s = np.broadcast_to(s, wm_bits.shape + s.shape[-1:]).copy()
+        s[..., 0] = (s[..., 0] // self.d1 + 1 / 4 + 1 / 2 * wm_bits) * self.d1
+        if self.d2 and not self.fast_mode:
+            s[..., 1] = (s[..., 1] // self.d2 + 1 / 4 + 1 / 2 * wm_bits) * self.d2
+        return s
+
+    def block_isvd_vec(self, u, s, v, shuffler):
+        # 逆svd->(flatten->解密->逆flatten)->逆dct
+        block_dct = (u * s[:, np.newaxis, :]) @ v
+        if not self.fast_mode:
+            block_dct_flatten = block_dct.reshape(block_dct.shape[0], -1)
+            np.put_along_axis(block_dct_flatten, shuffler, block_dct_flatten.copy(), axis=1)
+            block_dct = block_dct_flatten.reshape(block_dct.shape)
+        return dct_blocks(block_dct, inverse=True)
+
+    def block_add_wm_vec(self, blocks, shuffler, wm_bits):
+        # 与 block_add_wm 相同的算法，但一次处理 (n, bs, bs) 的全部分块
+        u, s, v = self.block_svd_vec(blocks, shuffler)
+        return self.block_isvd_vec(u, self.block_add_wm_s(s, wm_bits), v, shuffler)
+
+    def block_svd_cached(self, channel):
+        # mode='cached'：同一张图、同一个 password_img 的 svd 分解结果只算一次
+        # 不同的 svd_kernel 得到的 u、v 符号可能不同，分开缓存
+        if self.img_key is None:
+            # 由不带 key 的 Decomposition 读入，没法缓存
+            return self.block_svd_vec(self.ca_block[channel], self.idx_shuffle)
+        key = (self.img_key, self.password_img, self.shuffle_strategy, self.fast_mode, self.svd_kernel, channel)
+        usv = decomposition_cache.get(key)
+        if usv is None:
+            usv = self.block_svd_vec(self.ca_block[channel], self.idx_shuffle)
+            decomposition_cache.put(key, usv)
+        return usv
+
+    def embed(self, out=None):
+        # out: 预先分配好的输出，例如 np.memmap，形状与返回的图片相同，结果写入 out 并返回 out
+        if self.strip_rows is not None:
+            return self.embed_tiled(out=out)
 
-    def embed(self):
         self.init_block_index()
 
-        embed_ca = copy.deepcopy(self.ca)
-        embed_YUV = [np.array([])] * 3
-
-        self.idx_shuffle = random_strategy1(self.password_img, self.block_num,
-                                            self.block_shape[0] * self.block_shape[1])
-        for channel in range(3):
-            tmp = self.pool.map(self.block_add_wm,
-                                [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i], i)
-                                 for i in range(self.block_num)])
-
-            for i in range(self.block_num):
-                self.ca_block[channel][self.block_index[i]] = tmp[i]
-
-            # 4维分块变回2维
-            self.ca_part[channel] = np.concatenate(np.concatenate(self.ca_block[channel], 1), 1)
-            # 4维分块时右边和下边不能整除的长条保留，其余是主体部分，换成 embed 之后的频域的数据
-            embed_ca[channel][:self.part_shape[0], :self.part_shape[1]] = self.ca_part[channel]
-            # 逆变换回去
-            embed_YUV[channel] = idwt2((embed_ca[channel], self.hvd[channel]), "haar")
-
-        # 合并3通道
-        embed_img_YUV = np.stack(embed_YUV, axis=2)
-        # 之前如果不是2的整数，增加了白边，这里去除掉
-        embed_img_YUV = embed_img_YUV[:self.img_shape[0], :self.img_shape[1]]
-        embed_img = cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR)
-        embed_img = np.clip(embed_img, a_min=0, a_max=255)
+        self.idx_shuffle = self.get_idx_shuffle()
+        embed_ca = [np.array([])] * 3
+        for channel in self.channels:
+            with self.stage('block_map'):
+                if self.pool.mode == 'cached':
+                    u, s, v = self.block_svd_cached(channel)
+                    wm_bits = self.wm_bit[np.arange(self.block_num) % self.wm_size]
+                    tmp = self.block_isvd_vec(u, self.block_add_wm_s(s, wm_bits), v, self.idx_shuffle)
+                else:
+                    tmp = self.block_add_wm_4d(self.ca_block[channel], self.idx_shuffle)
+
+            # 分块直接写入新的 ca，不修改 self.ca，cached 模式下缓存中的分解结果保持原样
+            with self.stage('merge_blocks'):
+                embed_ca[channel] = self.ca_with_blocks(channel, tmp)
+
+        embed_img = self.ca_to_img(embed_ca)
+        if out is not None:
+            with self.stage('write_out'):
+                write_rows(out, 0, embed_img)
+            return out
+        return embed_img
 
+    def ca_with_blocks(self, channel, blocks):
+        # 返回一个新的 ca：分块部分是 blocks，右边和下边不能整除的细条保留原来 self.ca 的值
+        # 只复制细条部分，分块通过可写的四维 view 一次写入
+        ca = self.ca[channel]
+        embed_ca = np.empty_like(ca)
+        embed_ca[self.part_shape[0]:, :] = ca[self.part_shape[0]:, :]
+        embed_ca[:self.part_shape[0], self.part_shape[1]:] = ca[:self.part_shape[0], self.part_shape[1]:]
+        block_view(embed_ca, self.ca_block_shape, writeable=True)[...] = blocks.reshape(self.ca_block_shape)
+        return embed_ca
+
+    def block_add_wm_4d(self, ca_block, idx_shuffle, block_offset=0):
+        # 对四维分块 ca_block 中的每个分块打水印，返回 (n, bs, bs)，顺序与 np.ndindex(ca_block.shape[:2]) 一致
+        # block_offset 是 ca_block 中第一个分块在整图中的序号
+        n_blocks = ca_block.shape[0] * ca_block.shape[1]
+        if self.pool.mode in ('vectorization', 'cached'):
+            wm_bits = self.wm_bit[np.arange(block_offset, block_offset + n_blocks) % self.wm_size]
+            return self.block_add_wm_vec(ca_block, idx_shuffle, wm_bits)
+
+        if self.pool.shared_memory:
+            # 分块、打乱顺序的索引和输出都放在共享内存里，子进程按连续的分块行处理
+            with self.stage('shm_copy'):
+                ca_block_shm, shuffler = SharedArray.copy_of(ca_block), SharedArray.copy_of(idx_shuffle)
+                out = SharedArray(ca_block.shape, np.float32)
+            with ca_block_shm, shuffler, out:
+                with self.stage('pool'):
+                    self.shm_map('block_add_wm_rows', block_offset, ca_block_shm, shuffler, out)
+                return out.array.reshape(-1, *self.block_shape).copy()
+
+        # 逐块计算的模式（以及没有共享内存时的 multiprocessing）：dct/idct 仍然对全部分块批量做，只把 svd 和量化交给 pool
+        ca_block_dct = dct_blocks(ca_block)
+        tmp = self.pool.map(self.block_add_wm,
+                            [(ca_block_dct[index], idx_shuffle[k], block_offset + k)
+                             for k, index in enumerate(np.ndindex(*ca_block.shape[:2]))])
+        return dct_blocks(np.array(tmp), inverse=True)
+
+    def shm_map(self, method, block_offset, *shared_arrays):
+        # multiprocessing 模式：按分块的行切分任务，每个任务只 pickle 少量参数和共享内存的名字
+        n_rows = shared_arrays[0].shape[0]
+        n_tasks = min(n_rows, 4 * self.pool.processes_num)
+        bounds = np.linspace(0, n_rows, n_tasks + 1).astype(int)
+        init_args = {'password_img': self.password_img, 'resist': self.d1, 'block_size': int(self.block_shape[0]),
+                     'svd_kernel': self.svd_kernel}
+        attrs = {'d2': self.d2, 'fast_mode': self.fast_mode, 'block_offset': block_offset,
+                 'wm_bit': getattr(self, 'wm_bit', None), 'wm_size': self.wm_size}
+        return self.pool.map(shm_worker, [(method, init_args, attrs, shared_arrays, (r0, r1))
+                                          for r0, r1 in zip(bounds[:-1], bounds[1:]) if r1 > r0])
+
+    def block_add_wm_rows(self, ca_block, shuffler, out, rows):
+        # 处理第 rows[0]~rows[1] 行分块，分块序号 i 是整图中的序号
+        i0, i1 = rows[0] * ca_block.shape[1], rows[1] * ca_block.shape[1]
+        blocks = ca_block.array[rows[0]:rows[1]].reshape(-1, *self.block_shape)
+        wm_bits = self.wm_bit[np.arange(self.block_offset + i0, self.block_offset + i1) % self.wm_size]
+        tmp = self.block_add_wm_vec(blocks, shuffler.array[i0:i1], wm_bits)
+        out.array[rows[0]:rows[1]] = tmp.reshape((-1,) + ca_block.shape[1:])
+
+    def block_get_wm_rows(self, ca_block, shuffler, rows):
+        i0, i1 = rows[0] * ca_block.shape[1], rows[1] * ca_block.shape[1]
+        blocks = ca_block.array[rows[0]:rows[1]].reshape(-1, *self.block_shape)
+        return self.block_get_wm_vec(blocks, shuffler.array[i0:i1])
+
+    def block_get_wm_dct_rows(self, block_dct, shuffler, rows):
+        i0, i1 = rows[0] * block_dct.shape[1], rows[1] * block_dct.shape[1]
+        return self.block_get_wm_dct(block_dct.array[rows[0]:rows[1]], shuffler.array[i0:i1])
+
+    def strips(self):
+        # 按行把图片切成若干条，每条的高度是 2*block_size 的整数倍，这样 dwt 后每条的分块与整图的分块完全对齐
+        step = 2 * self.block_shape[0]
+        strip_rows = max(step, self.strip_rows // step * step)
+        for y0 in range(0, self.img_shape[0], strip_rows):
+            yield y0, min(y0 + strip_rows, self.img_shape[0])
+
+    def read_img_strip(self, y0, y1):
+        # 与 read_img_arr 相同的计算，只作用于第 y0~y1 行像素
+        # 返回每个通道的 ca、hvd、四维分块，这一条的第一个分块在整图中的序号，以及这一条的 YUV 图
+        img = self.img[y0:y1].astype(np.float32)
+        img_YUV = cv2.copyMakeBorder(cv2.cvtColor(img, cv2.COLOR_BGR2YUV),
+                                     0, img.shape[0] % 2, 0, img.shape[1] % 2,
+                                     cv2.BORDER_CONSTANT, value=(0, 0, 0))
+
+        r0 = y0 // (2 * self.block_shape[0])
+        r1 = min(r0 + img_YUV.shape[0] // (2 * self.block_shape[0]), self.ca_block_shape[0])
+        ca_block_shape = (r1 - r0,) + tuple(self.ca_block_shape[1:])
+
+        ca, hvd, ca_block = [np.array([])] * 3, [np.array([])] * 3, [np.array([])] * 3
+        for channel in self.channels:
+            ca[channel], hvd[channel] = dwt2(img_YUV[:, :, channel], 'haar')
+            ca_block[channel] = block_view(ca[channel], ca_block_shape)
+        return ca, hvd, ca_block, r0 * self.ca_block_shape[1], img_YUV
+
+    def embed_tiled(self, out=None):
+        # 分条打水印：结果与整图一次处理完全相同，但内存占用只与每条的大小有关
+        # 指定 out 时每条算完就写入 out，不在内存中拼出整张图
+        self.init_block_index()
+        if out is not None:
+            assert tuple(out.shape) == tuple(self.img_shape) + (3 if self.alpha is None else 4,), \
+                'out.shape should be {}'.format(tuple(self.img_shape) + (3 if self.alpha is None else 4,))
+
+        # 与 get_idx_shuffle 是同一个随机数序列，按条依次取出对应的部分
+        shuffle_stream = ShuffleStream(self.password_img, self.block_shape[0] * self.block_shape[1],
+                                       self.shuffle_strategy)
+        embed_img = None
+        for y0, y1 in self.strips():
+            with self.stage('read_strip'):
+                ca, hvd, ca_block, block_offset, img_YUV = self.read_img_strip(y0, y1)
+            n_rows = ca_block[self.channels[0]].shape[0]
+            with self.stage('shuffle'):
+                idx_shuffle = shuffle_stream.next(n_rows * self.ca_block_shape[1])
+
+            embed_YUV = [img_YUV[:, :, channel] for channel in range(3)]  # 不用的通道保持原样
+            for channel in self.channels:
+                if n_rows > 0:
+                    with self.stage('block_map'):
+                        tmp = self.block_add_wm_4d(ca_block[channel], idx_shuffle, block_offset)
+                    with self.stage('merge_blocks'):
+                        # 这一条的 ca 是新算出来的，直接原地写入
+                        block_view(ca[channel], ca_block[channel].shape, writeable=True)[...] = \
+                            tmp.reshape(ca_block[channel].shape)
+                with self.stage('idwt'):
+                    embed_YUV[channel] = idwt2((ca[channel], hvd[channel]), "haar")
+
+            with self.stage('to_bgr'):
+                embed_img_YUV = np.stack(embed_YUV, axis=2)[:y1 - y0, :self.img_shape[1]]
+                embed_strip = np.clip(cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR), a_min=0, a_max=255)
+            if out is not None:
+                with self.stage('write_out'):
+                    if self.alpha is not None:
+                        embed_strip = cv2.merge([embed_strip.astype(np.uint8), self.alpha[y0:y1]])
+                    write_rows(out, y0, embed_strip)
+                continue
+            if embed_img is None:
+                embed_img = np.empty(tuple(self.img_shape) + (3,), dtype=embed_strip.dtype)
+            embed_img[y0:y1] = embed_strip
+
+        if out is not None:
+            if isinstance(out, np.memmap):
+                out.flush()
+            return out
         if self.alpha is not None:
             embed_img = cv2.merge([embed_img.astype(np.uint8), self.alpha])
         return embed_img
 
+    def ca_to_img(self, embed_ca):
+        with self.stage('idwt'):
+            # 逆变换回去，不用的通道没有修改，直接取原来的 YUV 图
+            embed_YUV = [idwt2((embed_ca[channel], self.hvd[channel]), "haar") if channel in self.channels
+                         else self.img_YUV[:, :, channel] for channel in range(3)]
+
+        with self.stage('to_bgr'):
+            # 合并3通道
+            embed_img_YUV = np.stack(embed_YUV, axis=2)
+            # 之前如果不是2的整数，增加了白边，这里去除掉
+            embed_img_YUV = embed_img_YUV[:self.img_shape[0], :self.img_shape[1]]
+            embed_img = cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR)
+            embed_img = np.clip(embed_img, a_min=0, a_max=255)
+
+            if self.alpha is not None:
+                embed_img = cv2.merge([embed_img.astype(np.uint8), self.alpha])
+        return embed_img
+
+    def embed_many(self, wm_bits, batch_size=16):
+        # 同一张图片打多个水印：dct/svd 分解只做一次，之后对 (N, block_num) 的 bit 矩阵批量量化，再逐个逆变换
+        # wm_bits 是多个一维 bit 数组，逐个 yield 打好水印的图片
+        assert self.strip_rows is None, 'embed_many needs the whole image, strip_rows is not supported'
+        self.wm_size = max(wm_bit.size for wm_bit in wm_bits)
+        self.init_block_index()
+
+        self.idx_shuffle = self.get_idx_shuffle()
+        with self.stage('svd'):
+            if self.pool.mode == 'cached':
+                usv = [self.block_svd_cached(channel) for channel in self.channels]
+            else:
+                usv = [self.block_svd_vec(self.ca_block[channel], self.idx_shuffle) for channel in self.channels]
+
+        block_idx = np.arange(self.block_num)
+        for start in range(0, len(wm_bits), batch_size):
+            wm_bit_matrix = np.stack([wm_bit[block_idx % wm_bit.size] for wm_bit in wm_bits[start:start + batch_size]])
+            s_wm = [self.block_add_wm_s(s, wm_bit_matrix) for u, s, v in usv]
+            for k in range(wm_bit_matrix.shape[0]):
+                embed_ca = [np.array([])] * 3
+                for i, (channel, (u, s, v)) in enumerate(zip(self.channels, usv)):
+                    with self.stage('block_map'):
+                        tmp = self.block_isvd_vec(u, s_wm[i][k], v, self.idx_shuffle)
+                    with self.stage('merge_blocks'):
+                        embed_ca[channel] = self.ca_with_blocks(channel, tmp)
+                yield self.ca_to_img(embed_ca)
+
     def block_get_wm(self, args):
         if self.fast_mode:
             return self.block_get_wm_fast(args)
@@ -144,11 +489,11 @@ class WaterMarkCore:
             return self.block_get_wm_slow(args)
 
     def block_get_wm_slow(self, args):
-        block, shuffler = args
-        # dct->flatten->加密->逆flatten->svd->解水印
-        block_dct_shuffled = dct(block).flatten()[shuffler].reshape(self.block_shape)
+        block_dct, shuffler = args
+        # flatten->加密->逆flatten->svd->解水印，分块的 dct 在 block_get_wm_4d 中批量完成
+        block_dct_shuffled = block_dct.flatten()[shuffler].reshape(self.block_shape)
 
-        u, s, v = svd(block_dct_shuffled)
+        u, s, v = self.svd(block_dct_shuffled)
         wm = (s[0] % self.d1 > self.d1 / 2) * 1
         if self.d2:
             tmp = (s[1] % self.d2 > self.d2 / 2) * 1
@@ -156,36 +501,93 @@ class WaterMarkCore:
         return wm
 
     def block_get_wm_fast(self, args):
-        block, shuffler = args
-        # dct->svd->解水印
-        u, s, v = svd(dct(block))
+        block_dct, shuffler = args
+        # svd->解水印
+        u, s, v = self.svd(block_dct)
         wm = (s[0] % self.d1 > self.d1 / 2) * 1
 
         return wm
 
+    def block_get_wm_vec(self, blocks, shuffler):
+        # 与 block_get_wm 相同的算法，但一次处理全部分块，且只求奇异值
+        # blocks 是 (n, bs, bs) 或四维的 (rows, cols, bs, bs)，返回 (n,)
+        return self.block_get_wm_dct(dct_blocks(blocks), shuffler)
+
+    def block_get_wm_dct(self, block_dct, shuffler):
+        # 与 block_get_wm_vec 相同，但传入的是已经做过 dct 的分块
+        block_dct = block_dct.reshape(-1, *self.block_shape)
+
+        if self.fast_mode:
+            s = self.svd(block_dct, compute_uv=False)
+            return (s[:, 0] % self.d1 > self.d1 / 2) * 1
+
+        block_dct_shuffled = np.take_along_axis(block_dct.reshape(block_dct.shape[0], -1), shuffler, axis=1) \
+            .reshape(block_dct.shape)
+        s = self.svd(block_dct_shuffled, compute_uv=False)
+        wm = (s[:, 0] % self.d1 > self.d1 / 2) * 1
+        if self.d2:
+            tmp = (s[:, 1] % self.d2 > self.d2 / 2) * 1
+            wm = (wm * 3 + tmp * 1) / 4
+        return wm
+
+    def block_get_wm_4d(self, ca_block, idx_shuffle, block_dct=None):
+        # 提取四维分块 ca_block 中每个分块的水印，返回 (n,)
+        # block_dct 是 ca_block 的 dct，已经算好时传入，跳过 dct
+        if self.pool.mode in ('vectorization', 'cached'):
+            if block_dct is not None:
+                return self.block_get_wm_dct(block_dct, idx_shuffle)
+            return self.block_get_wm_vec(ca_block, idx_shuffle)
+
+        if self.pool.shared_memory:
+            method = 'block_get_wm_rows' if block_dct is None else 'block_get_wm_dct_rows'
+            with self.stage('shm_copy'):
+                ca_block_shm = SharedArray.copy_of(ca_block if block_dct is None else block_dct)
+                shuffler = SharedArray.copy_of(idx_shuffle)
+            with ca_block_shm, shuffler, self.stage('pool'):
+                return np.concatenate(self.shm_map(method, 0, ca_block_shm, shuffler))
+
+        ca_block_dct = dct_blocks(ca_block) if block_dct is None else block_dct
+        return self.pool.map(self.block_get_wm,
+                             [(ca_block_dct[index], idx_shuffle[k])
+                              for k, index in enumerate(np.ndindex(*ca_block.shape[:2]))])
+
     def extract_raw(self, img):
         # 每个分块提取 1 bit 信息
         self.read_img_arr(img=img)
         self.init_block_index()
 
-        wm_block_bit = np.zeros(shape=(3, self.block_num))  # 3个channel，length 个分块提取的水印，全都记录下来
-
-        self.idx_shuffle = random_strategy1(seed=self.password_img,
-                                            size=self.block_num,
-                                            block_shape=self.block_shape[0] * self.block_shape[1],  # 16
-                                            )
-        for channel in range(3):
-            wm_block_bit[channel, :] = self.pool.map(self.block_get_wm,
-                                                     [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i])
-                                                      for i in range(self.block_num)])
+        # 每个用到的 channel 一行，length 个分块提取的水印，全都记录下来
+        wm_block_bit = np.zeros(shape=(len(self.channels), self.block_num))
+
+        if self.strip_rows is not None and not isinstance(img, Decomposition):
+            # 分条提取，与 embed_tiled 相同
+            shuffle_stream = ShuffleStream(self.password_img, self.block_shape[0] * self.block_shape[1],
+                                       self.shuffle_strategy)
+            for y0, y1 in self.strips():
+                with self.stage('read_strip'):
+                    ca, hvd, ca_block, block_offset, _ = self.read_img_strip(y0, y1)
+                n_blocks = ca_block[self.channels[0]].shape[0] * ca_block[self.channels[0]].shape[1]
+                if n_blocks == 0:
+                    continue
+                with self.stage('shuffle'):
+                    idx_shuffle = shuffle_stream.next(n_blocks)
+                for i, channel in enumerate(self.channels):
+                    with self.stage('block_map'):
+                        wm_block_bit[i, block_offset:block_offset + n_blocks] = \
+                            self.block_get_wm_4d(ca_block[channel], idx_shuffle)
+            return wm_block_bit
+
+        self.idx_shuffle = self.get_idx_shuffle()
+        for i, channel in enumerate(self.channels):
+            with self.stage('block_map'):
+                wm_block_bit[i, :] = self.block_get_wm_4d(self.ca_block[channel], self.idx_shuffle,
+                                                          self.block_dct[channel])
         return wm_block_bit
 
-    def extract_avg(self, wm_block_bit):
-        # 对循环嵌入+3个 channel 求平均
-        wm_avg = np.zeros(shape=self.wm_size)
-        for i in range(self.wm_size):
-            wm_avg[i] = wm_block_bit[:, i::self.wm_size].mean()
-        return wm_avg
+    def extract_avg(self, wm_block_bit, weights=None):
+        # 对循环嵌入+各个 channel 求平均
+        with self.stage('average'):
+            return bit_stats(wm_block_bit, self.wm_size, weights=weights)[0]
 
     def extract(self, img, wm_shape):
         self.wm_size = np.array(wm_shape).prod()
@@ -196,11 +598,103 @@ class WaterMarkCore:
         wm_avg = self.extract_avg(wm_block_bit)
         return wm_avg
 
+    def extract_stats(self, img, wm_shape, weights=None):
+        # 与 extract 相同，但返回每个 bit 的 (均值, 方差, 投票数)
+        self.wm_size = np.array(wm_shape).prod()
+        wm_block_bit = self.extract_raw(img=img)
+        with self.stage('average'):
+            return bit_stats(wm_block_bit, self.wm_size, weights=weights)
+
     def extract_with_kmeans(self, img, wm_shape):
         wm_avg = self.extract(img=img, wm_shape=wm_shape)
 
         return one_dim_kmeans(wm_avg)
 
+    def extract_stream(self, img, wm_shape, margin=0.05, delta=1e-3, batch_size=None):
+        '''
+        按随机顺序分批提取分块，每个 bit 都足够确定后提前停止
+        :param margin: 每个 bit 的 confidence 都不小于 margin 时停止
+        :param delta: 允许的出错概率，越小需要的分块越多
+        :param batch_size: 每批提取的分块数，默认 max(1024, 4 * wm_size)
+        :return: (wm_avg, confidence)
+            confidence 由 Hoeffding 不等式给出：以至少 1 - delta 的概率，bit 的真实均值与 0.5 的距离不小于 confidence
+            confidence 小于 0 说明该 bit 还不能确定
+        '''
+        img = self.whole_img(img)
+        assert self.strip_rows is None, 'extract_stream does not support strip_rows'
+        self.wm_size = np.array(wm_shape).prod()
+        self.read_img_arr(img=img)
+        self.init_block_index()
+        self.idx_shuffle = self.get_idx_shuffle()
+        batch_size = batch_size or max(1024, 4 * self.wm_size)
+        n_cols = self.ca_block_shape[1]
+
+        # 分块的访问顺序是随机的，这样图片的每个区域（以及每个 bit）都能尽早被采样到
+        order = np.random.RandomState(self.password_img).permutation(self.block_num)
+        vote_sum, vote_cnt = np.zeros(self.wm_size), np.zeros(self.wm_size)
+        for start in range(0, self.block_num, batch_size):
+            idx = order[start:start + batch_size]
+            wm_idx = idx % self.wm_size
+            for channel in self.channels:
+                with self.stage('block_map'):
+                    if self.block_dct[channel] is not None:
+                        wm = self.block_get_wm_dct(self.block_dct[channel][idx // n_cols, idx % n_cols],
+                                                   self.idx_shuffle[idx])
+                    else:
+                        wm = self.block_get_wm_vec(self.ca_block[channel][idx // n_cols, idx % n_cols],
+                                                   self.idx_shuffle[idx])
+                vote_sum += np.bincount(wm_idx, weights=wm, minlength=self.wm_size)
+            vote_cnt += len(self.channels) * np.bincount(wm_idx, minlength=self.wm_size)
+
+            wm_avg, confidence = vote_confidence(vote_sum, vote_cnt, delta)
+            if confidence.min() >= margin:
+                break
+        return wm_avg, confidence
+
+
+class Decomposition:
+    '''
+    一张图片的分解结果，由 WaterMarkCore.decompose 生成，可以 pickle
+    img_YUV: 加白边后的 YUV 图，只用到部分通道时，嵌入需要它还原其余通道
+    ca, hvd: 每个通道 dwt 的结果，不用的通道是空 array
+    block_dct: 每个通道 ca 四维分块的 dct，(rows, cols, bs, bs)，可以为 None
+    key: mode='cached' 时缓存的 key
+    '''
+
+    def __init__(self, alpha, img_shape, ca_shape, ca_block_shape, channels, img_YUV, ca, hvd, block_dct=None,
+                 key=None):
+        self.alpha = alpha
+        self.img_shape, self.ca_shape = tuple(img_shape), tuple(ca_shape)
+        self.ca_block_shape = tuple(int(i) for i in ca_block_shape)
+        self.channels = channels
+        self.img_YUV, self.ca, self.hvd, self.block_dct = img_YUV, ca, hvd, block_dct
+        self.key = key
+
+
+@contextmanager
+def no_stage():
+    # 不记录阶段时的空 with 块，与 Python 3.7 的 contextlib.nullcontext 相同
+    yield
+
+
+def parse_channels(channels):
+    # 'YUV'、('U', 'V')、(0,) 等写法都转为升序的通道序号，Y=0、U=1、V=2
+    channels = tuple('YUV'.index(i.upper()) if isinstance(i, str) else int(i) for i in channels)
+    assert channels and set(channels) <= {0, 1, 2}, "channels is a non-empty subset of 'YUV'"
+    return tuple(sorted(set(channels)))
+
+
+def shm_worker(args):
+    # multiprocessing 模式下在子进程中执行，数据全部来自共享内存
+    method, init_args, attrs, shared_arrays, rows = args
+    core = WaterMarkCore(**init_args)
+    core.__dict__.update(attrs)
+    try:
+        return getattr(core, method)(*shared_arrays, rows)
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.close()
+
 
 def one_dim_kmeans(inputs):
     threshold = 0
@@ -218,6 +712,50 @@ def one_dim_kmeans(inputs):
     return is_class01
 
 
+def bit_stats(wm_block_bit, wm_size, weights=None):
+    '''
+    第 k 个分块埋的是第 k % wm_size 个 bit，按此把 (n_channel, block_num) 的提取结果聚合到每个 bit
+    :param weights: 每个 channel 的权重，默认都是 1
+    :return: (mean, var, count)，都是 (wm_size,)，count 是投票数（分块数 * channel 数）
+    '''
+    n_channel, block_num = wm_block_bit.shape
+    weights = np.ones(n_channel) if weights is None else np.asarray(weights, dtype=float)
+    bit_index = np.arange(block_num) % wm_size
+
+    # 先按 channel 加权求和，每个统计量只需一次 bincount
+    block_cnt = np.bincount(bit_index, minlength=wm_size)
+    sum1 = np.bincount(bit_index, weights=weights @ wm_block_bit, minlength=wm_size)
+    sum2 = np.bincount(bit_index, weights=weights @ wm_block_bit ** 2, minlength=wm_size)
+
+    total_weight = np.maximum(block_cnt * weights.sum(), np.finfo(float).tiny)
+    mean = sum1 / total_weight
+    var = np.maximum(sum2 / total_weight - mean ** 2, 0)
+    return mean, var, block_cnt * n_channel
+
+
+def vote_confidence(vote_sum, vote_cnt, delta):
+    # 每个 bit 的投票都在 [0, 1] 内，用 Hoeffding 不等式给出 |均值 - 0.5| 的下界
+    cnt = np.maximum(vote_cnt, 1)
+    wm_avg = vote_sum / cnt
+    confidence = np.abs(wm_avg - 0.5) - np.sqrt(np.log(2 / delta) / (2 * cnt))
+    confidence[vote_cnt == 0] = -np.inf
+    return wm_avg, confidence
+
+
+def write_rows(out, y0, rows):
+    # 把打好水印的若干行写入 out 的第 y0 行起，out 是整数类型时与 cv2.imwrite 相同，先四舍五入
+    if np.issubdtype(out.dtype, np.integer) and not np.issubdtype(rows.dtype, np.integer):
+        rows = np.round(rows)
+    out[y0:y0 + rows.shape[0]] = rows
+
+
+def block_view(arr, ca_block_shape, writeable=False):
+    # 把二维的 arr 左上角切成 ca_block_shape=(rows, cols, bs, bs) 的四维分块，是 arr 的 view，不复制数据
+    stride0, stride1 = arr.strides
+    strides = (stride0 * ca_block_shape[2], stride1 * ca_block_shape[3], stride0, stride1)
+    return np.lib.stride_tricks.as_strided(arr, ca_block_shape, strides, writeable=writeable)
+
+
 def random_strategy1(seed, size, block_shape):
     return np.random.RandomState(seed) \
         .random(size=(size, block_shape)) \
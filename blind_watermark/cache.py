@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def img_hash(img):
+    # 图片内容 + 形状 + 类型 的摘要，作为缓存的 key
+    img = np.ascontiguousarray(img)
+    h = hashlib.sha1(str((img.shape, img.dtype.str)).encode('utf-8'))
+    h.update(img.data)
+    return h.hexdigest()
+
+
+def nbytes_of(value):
+    # 统计 value 中所有 np.ndarray 占用的字节数，支持嵌套的 list/tuple/dict，以及对象的属性
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes_of(i) for i in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes_of(i) for i in value)
+    if hasattr(value, '__dict__'):
+        return nbytes_of(vars(value))
+    return 0
+
+
+class LRUCache(object):
+    '''
+    按字节数限制容量的 LRU 缓存，线程安全
+    :param max_items: 另外限制条目数，缓存的对象很小（几乎不含 np.ndarray）时用它限制容量
+    '''
+
+    def __init__(self, max_bytes=1 << 30, max_items=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        nbytes = nbytes_of(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if nbytes > self.max_bytes:
+                # 单个对象就超过了容量，不缓存
+                return
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes or (self.max_items is not None and len(self._data) > self.max_items):
+                _, (_, old_nbytes) = self._data.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+# mode='cached' 时，所有 WaterMarkCore 共用这个缓存
+# 调整容量：blind_watermark.cache.decomposition_cache.max_bytes = 4 << 30
+decomposition_cache = LRUCache()
@@ -0,0 +1,57 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+def svd_eig(b, compute_uv=True):
+    '''
+    与 np.linalg.svd 相同的接口，支持 (..., n, n) 批量计算。用 BᵀB 的特征分解代替 svd，分块很小时快很多：
+    BᵀB 的特征值是 B 的奇异值的平方，特征向量是 B 的右奇异向量 v，左奇异向量 u = Bv / s
+    只求奇异值（compute_uv=False，提取水印时）只需要 eigvalsh
+
+    打水印会修改前两个奇异值，它们的 u 必须准确。s[1] 相对 s[0] 太小（秩亏）时 Bv / s 不稳定，这些分块退回 np.linalg.svd
+    '''
+    b64 = b.astype(np.float64)
+    gram = np.swapaxes(b64, -1, -2) @ b64
+
+    if not compute_uv:
+        # eigvalsh 返回升序，svd 是降序
+        return np.sqrt(np.maximum(np.linalg.eigvalsh(gram)[..., ::-1], 0)).astype(b.dtype)
+
+    w, v = np.linalg.eigh(gram)
+    s, v = np.sqrt(np.maximum(w[..., ::-1], 0)), v[..., ::-1]
+    # 其余的奇异值不会被修改，逆 svd 时只用到 u * s = Bv；s 约为 0 时 Bv 也约为 0，u 取 0 即可
+    nonzero = s > 1e-12 * s[..., :1]
+    u = (b64 @ v) * np.where(nonzero, 1 / np.where(nonzero, s, 1), 0)[..., np.newaxis, :]
+    vh = np.swapaxes(v, -1, -2)
+
+    rank_deficient = s[..., 1] <= 1e-4 * s[..., 0]
+    if rank_deficient.any():
+        u[rank_deficient], s[rank_deficient], vh[rank_deficient] = np.linalg.svd(b64[rank_deficient])
+    return u.astype(b.dtype), s.astype(b.dtype), vh.astype(b.dtype)
+
+
+# WaterMarkCore(svd_kernel=...) 可选的 svd 实现
+SVD_KERNELS = {
+    'lapack': np.linalg.svd,
+    'eig': svd_eig,
+}
+
+
+@lru_cache(maxsize=None)
+def dct_matrix(n, dtype=np.float64):
+    # 正交归一化的 DCT-II 基矩阵 C，与 cv2.dct 一致：dct(x) = C @ x @ C.T，idct(y) = C.T @ y @ C
+    k, i = np.arange(n)[:, np.newaxis], np.arange(n)[np.newaxis, :]
+    mat = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    mat[0, :] = np.sqrt(1 / n)
+    mat = mat.astype(dtype)
+    mat.flags.writeable = False
+    return mat
+
+
+def dct_blocks(blocks, inverse=False):
+    # 对 (..., bs, bs) 的全部分块批量做 dct/idct，两次矩阵乘法，例如 read_img_arr 得到的四维 ca_block 可以直接传入
+    mat = dct_matrix(blocks.shape[-1], blocks.dtype)
+    if inverse:
+        return mat.T @ blocks @ mat
+    return mat @ blocks @ mat.T
@@ -2,6 +2,14 @@ import sys
 import multiprocessing
 import warnings
 
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python 3.8 以前没有共享内存，multiprocessing 模式退回逐块 pickle 的 Pool.map
+    resource_tracker = shared_memory = None
+
 if sys.platform != 'win32':
     multiprocessing.set_start_method('fork')
 
@@ -10,6 +18,45 @@ class CommonPool(object):
     def map(self, func, args):
         return list(map(func, args))
 
+    def imap_unordered(self, func, args):
+        return map(func, args)
+
+
+class SharedArray(object):
+    '''
+    放在共享内存中的 np.ndarray。pickle 时只传共享内存的名字，子进程按名字挂载，不复制数据
+    '''
+
+    def __init__(self, shape, dtype, name=None):
+        assert shared_memory is not None, 'SharedArray needs multiprocessing.shared_memory (Python 3.8+)'
+        self.shape, self.dtype = tuple(int(i) for i in shape), np.dtype(dtype)
+        self.owner = name is None
+        nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nbytes if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def copy_of(cls, arr):
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    def __reduce__(self):
+        return SharedArray, (self.shape, self.dtype.str, self.shm.name)
+
+    def close(self):
+        # 关闭前，由 self.array 派生出的视图需要先释放
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class AutoPool(object):
     def __init__(self, mode, processes):
@@ -20,19 +67,34 @@ class AutoPool(object):
 
         self.mode = mode
         self.processes = processes
+        self.processes_num = processes or multiprocessing.cpu_count()
+        # 是否用 SharedArray 把数据传给子进程
+        self.shared_memory = mode == 'multiprocessing' and shared_memory is not None
 
-        if mode == 'vectorization':
-            pass
-        elif mode == 'cached':
-            pass
+        if mode in ('vectorization', 'cached'):
+            # 由 WaterMarkCore 直接对全部分块做批量计算（cached 另外缓存分解结果），这里只保留逐个 map 的兜底
+            self.pool = CommonPool()
         elif mode == 'multithreading':
             from multiprocessing.dummy import Pool as ThreadPool
             self.pool = ThreadPool(processes=processes)
         elif mode == 'multiprocessing':
             from multiprocessing import Pool
+            if self.shared_memory:
+                # 先启动 resource_tracker 再 fork，子进程与主进程共用它来回收 SharedArray
+                resource_tracker.ensure_running()
             self.pool = Pool(processes=processes)
         else:  # common
             self.pool = CommonPool()
 
     def map(self, func, args):
         return self.pool.map(func, args)
+
+    def imap_unordered(self, func, args):
+        # 每完成一个任务就返回它的结果，顺序不定
+        return self.pool.imap_unordered(func, args)
+
+    def close(self):
+        # 进程池、线程池用完后释放
+        if hasattr(self.pool, 'close'):
+            self.pool.close()
+            self.pool.join()
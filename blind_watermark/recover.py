@@ -1,88 +1,271 @@
+import threading
+
 import cv2
 import numpy as np
 
-import functools
+from .cache import LRUCache, img_hash
+from .pool import AutoPool
+
+
+def pyramid_levels(template_shape, min_scale, min_size=16, max_levels=4):
+    # 缩到最小的模板，较短的一边在粗搜的图上不小于 min_size
+    levels, size = 0, min(template_shape[:2]) * min_scale
+    while levels < max_levels and size / 2 ** (levels + 1) >= min_size:
+        levels += 1
+    return levels
+
+
+def match_in_window(image, template, w, h, window=None):
+    # 把 template 缩放到 (w, h) 后在 image 的 window=(y0, y1, x0, x1) 范围内匹配，返回整图中的位置和分数
+    y0, y1, x0, x1 = window or (0, image.shape[0], 0, image.shape[1])
+    scores = cv2.matchTemplate(image[y0:y1, x0:x1], cv2.resize(template, dsize=(w, h)), cv2.TM_CCOEFF_NORMED)
+    ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
+    return (int(ind[0]) + y0, int(ind[1]) + x0), scores[ind]
+
+
+class TemplateMatcher(object):
+    '''
+    在一张原图中寻找缩放后的模板（截图、剪切后的图片），推测模板在原图中的位置和缩放比例
+
+    matcher = TemplateMatcher(ori_img)
+    (x1, y1, x2, y2), image_o_shape, score, scale_infer = matcher.estimate(tem_img, scale=(0.5, 2))
+    results = matcher.estimate_many([tem_img1, tem_img2], processes=4)
+
+    匹配结果缓存在实例自己的 LRU 缓存中，最多 cache_items 条，实例不再使用时随之释放
+    线程安全，多个线程可以同时使用同一个实例，cv2.matchTemplate 计算时会释放 GIL
+    '''
+
+    def __init__(self, ori_img, cache_items=4096):
+        self.image = ori_img
+        self.cache = LRUCache(max_items=cache_items)
+        self._pyramid = [ori_img]  # 原图的金字塔，按需生成，多次搜索共用
+        self._lock = threading.Lock()
+
+    def pyramid(self, levels):
+        # 原图分别缩小 2**0, ..., 2**levels 倍
+        with self._lock:
+            while len(self._pyramid) <= levels:
+                self._pyramid.append(cv2.pyrDown(self._pyramid[-1]))
+            return self._pyramid[:levels + 1]
+
+    def match(self, template, template_key, level, w, h, window=None):
+        # 带缓存的 match_in_window，template 是金字塔第 level 层的模板，template_key 用来区分不同的模板
+        key = (template_key, level, w, h, window)
+        result = self.cache.get(key)
+        if result is None:
+            result = match_in_window(self.pyramid(level)[level], template, w, h, window)
+            self.cache.put(key, result)
+        return result
+
+    def match_many(self, tasks, pool):
+        # tasks: [(template, template_key, level, w, h, window), ...]，各个 scale 互不依赖，在 pool 中并行匹配
+        return pool.map(lambda task: self.match(*task), tasks)
+
+    def search(self, template, scale=(0.5, 2), search_num=200, levels=None, processes=None):
+        '''
+        在原图中寻找缩放后的 template，返回 [ind, score, scale]
+        :param levels: 金字塔的层数，先在缩小 2**levels 倍的图上粗搜，再逐层放大，只搜索上一层结果的附近
+            None 时按模板大小自动选择，0 时在原图上暴力搜索全部 scale
+        :param processes: 并行匹配各个 scale 的线程数，默认使用全部 CPU，1 时在当前线程中逐个计算
+        '''
+        if levels is None:
+            levels = pyramid_levels(template.shape, scale[0])
+        template_key = img_hash(template)
+        pool = AutoPool(mode='common' if processes == 1 else 'multithreading', processes=processes)
+        try:
+            if levels == 0:
+                return self.search_linear(template, template_key, pool, scale=scale, search_num=search_num)
+            return self.search_pyramid(template, template_key, pool, scale=scale, search_num=search_num,
+                                       levels=levels)
+        finally:
+            pool.close()
+
+    def search_pyramid(self, template, template_key, pool, scale=(0.5, 2), search_num=200, levels=2, top_k=3):
+        image = self.image
+        min_scale, max_scale = scale
+        max_scale = min(max_scale, image.shape[0] / template.shape[0], image.shape[1] / template.shape[1])
+
+        # pyramid[i] 是缩小 2**i 倍的 (image, template)
+        templates = [template]
+        for _ in range(levels):
+            templates.append(cv2.pyrDown(templates[-1]))
+        pyramid = list(zip(self.pyramid(levels), templates))
+
+        # 1. 在最小的一层上对全部 scale 粗搜，缩小后尺寸相同的 scale 只算一次
+        image_small, template_small = pyramid[-1]
+        tasks, scales, sizes = [], [], set()
+        for s in np.linspace(min_scale, max_scale, search_num):
+            w, h = round(template_small.shape[1] * s), round(template_small.shape[0] * s)
+            if (w, h) in sizes or not (0 < w <= image_small.shape[1] and 0 < h <= image_small.shape[0]):
+                continue
+            sizes.add((w, h))
+            tasks.append((template_small, template_key, levels, w, h, None))
+            scales.append(s)
+        coarse = [[ind, score, s] for (ind, score), s in zip(self.match_many(tasks, pool), scales)]
+
+        # 取分数最高的 top_k 个候选，scale 相邻的只留一个
+        candidates = []
+        for idx in np.argsort([-score for ind, score, s in coarse]):
+            if all(abs(idx - i) > 2 for i in candidates):
+                candidates.append(idx)
+            if len(candidates) == top_k:
+                break
+        candidates = [(coarse[idx][0], coarse[idx][2]) for idx in candidates]
+
+        # 2. 逐层放大，每层只在上一层结果的 scale 附近、位置附近细搜，只保留最好的一个
+        # 中间各层按模板尺寸每次变化约 1 像素搜索，原图上每次变化约 0.5 像素，缩放后尺寸相同的只算一次
+        delta = max(2 / min(template_small.shape[:2]), (max_scale - min_scale) / max(search_num - 1, 1))
+        best = None
+        for level in range(levels - 1, -1, -1):
+            image_level, template_level = pyramid[level]
+            template_size = max(template_level.shape[:2])
+            step = (0.5 if level == 0 else 1) / template_size
+            margin = 4 + int(np.ceil(delta * template_size))
+            tasks, scales = [], []
+            for ind, s in candidates:
+                y, x = 2 * ind[0], 2 * ind[1]
+                sizes = set()
+                for s in np.linspace(max(min_scale, s - delta), min(max_scale, s + delta), 2 * round(delta / step) + 1):
+                    w, h = round(template_level.shape[1] * s), round(template_level.shape[0] * s)
+                    if (w, h) in sizes:
+                        continue
+                    sizes.add((w, h))
+                    window = (max(0, y - margin), min(image_level.shape[0], y + h + margin),
+                              max(0, x - margin), min(image_level.shape[1], x + w + margin))
+                    tasks.append((template_level, template_key, level, w, h, window))
+                    scales.append(s)
+            result = [[ind, score, s] for (ind, score), s in zip(self.match_many(tasks, pool), scales)]
+            best = max(result, key=lambda item: item[1])
+            # 上一层的 scale 误差约为该层的 2 个像素
+            candidates, delta = [(best[0], best[2])], 2 / template_size
+        return best
+
+    def search_linear(self, template, template_key, pool, scale=(0.5, 2), search_num=200):
+        image = self.image
+        # 局部暴力搜索算法，寻找最优的scale
+        tmp = []
+        min_scale, max_scale = scale
+
+        max_scale = min(max_scale, image.shape[0] / template.shape[0], image.shape[1] / template.shape[1])
 
+        max_idx = 0
+
+        for i in range(2):
+            scales = np.linspace(min_scale, max_scale, search_num)
+            tasks = [(template, template_key, 0, round(template.shape[1] * scale), round(template.shape[0] * scale))
+                     for scale in scales]
+            tmp.extend([ind, score, scale] for (ind, score), scale in zip(self.match_many(tasks, pool), scales))
+
+            # 寻找最佳
+            max_idx = 0
+            max_score = 0
+            for idx, (ind, score, scale) in enumerate(tmp):
+                if score > max_score:
+                    max_idx, max_score = idx, score
+
+            min_scale, max_scale = tmp[max(0, max_idx - 1)][2], tmp[min(len(tmp) - 1, max_idx + 1)][2]
+
+            search_num = 2 * int((max_scale - min_scale) * max(template.shape[1], template.shape[0])) + 1
+
+        return tmp[max_idx]
 
-# 一个帮助缓存化加速的类，引入事实上的全局变量
+    def estimate(self, tem_img, scale=(0.5, 2), search_num=200, levels=None, processes=None):
+        # 推测 tem_img 在原图中的位置、大小，返回值与 estimate_crop_parameters 相同
+        ori_img = self.image
+        if scale[0] == scale[1] == 1:
+            # 不缩放
+            scale_infer = 1
+            scores = cv2.matchTemplate(ori_img, tem_img, cv2.TM_CCOEFF_NORMED)
+            ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
+            ind, score = ind, scores[ind]
+        else:
+            ind, score, scale_infer = self.search(tem_img, scale=scale, search_num=search_num, levels=levels,
+                                                  processes=processes)
+        w, h = int(tem_img.shape[1] * scale_infer), int(tem_img.shape[0] * scale_infer)
+        x1, y1, x2, y2 = ind[1], ind[0], ind[1] + w, ind[0] + h
+        return (x1, y1, x2, y2), ori_img.shape, score, scale_infer
+
+    def estimate_many(self, tem_imgs, scale=(0.5, 2), search_num=200, levels=None, processes=None):
+        # 在线程池中同时推测多个模板，按顺序返回每个模板的 estimate 结果，每个模板内部不再并行
+        pool = AutoPool(mode='multithreading', processes=processes)
+        try:
+            return pool.map(lambda tem_img: self.estimate(tem_img, scale=scale, search_num=search_num, levels=levels,
+                                                          processes=1), tem_imgs)
+        finally:
+            pool.close()
+
+
+# 以前的接口：原图和模板放在全局的 my_value 中，再调用 search_template/match_template
+# 现在都交给 my_value.matcher（TemplateMatcher），新代码请直接使用 TemplateMatcher
 class MyValues:
     def __init__(self):
         self.idx = 0
         self.image, self.template = None, None
+        self.matcher = None
 
     def set_val(self, image, template):
         self.idx += 1
         self.image, self.template = image, template
+        self.matcher = TemplateMatcher(image)
 
 
 my_value = MyValues()
 
 
-@functools.lru_cache(maxsize=None, typed=False)
 def match_template(w, h, idx):
-    image, template = my_value.image, my_value.template
-    resized = cv2.resize(template, dsize=(w, h))
-    scores = cv2.matchTemplate(image, resized, cv2.TM_CCOEFF_NORMED)
-    ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
-    return ind, scores[ind]
+    # my_value 中的模板缩放到 (w, h) 后在原图中匹配，返回 (ind, score)；idx 区分 set_val 设置的不同模板
+    return my_value.matcher.match(my_value.template, idx, 0, w, h)
 
 
 def match_template_by_scale(scale):
-    image, template = my_value.image, my_value.template
+    template = my_value.template
     w, h = round(template.shape[1] * scale), round(template.shape[0] * scale)
     ind, score = match_template(w, h, idx=my_value.idx)
     return ind, score, scale
 
 
-def search_template(scale=(0.5, 2), search_num=200):
-    image, template = my_value.image, my_value.template
-    # 局部暴力搜索算法，寻找最优的scale
-    tmp = []
-    min_scale, max_scale = scale
-
-    max_scale = min(max_scale, image.shape[0] / template.shape[0], image.shape[1] / template.shape[1])
-
-    max_idx = 0
-
-    for i in range(2):
-        for scale in np.linspace(min_scale, max_scale, search_num):
-            ind, score, scale = match_template_by_scale(scale)
-            tmp.append([ind, score, scale])
-
-        # 寻找最佳
-        max_idx = 0
-        max_score = 0
-        for idx, (ind, score, scale) in enumerate(tmp):
-            if score > max_score:
-                max_idx, max_score = idx, score
-
-        min_scale, max_scale = tmp[max(0, max_idx - 1)][2], tmp[min(len(tmp) - 1, max_idx + 1)][2]
-
-        search_num = 2 * int((max_scale - min_scale) * max(template.shape[1], template.shape[0])) + 1
-
-    return tmp[max_idx]
+def search_template(scale=(0.5, 2), search_num=200, levels=None, processes=None):
+    # 在 my_value.image 中寻找缩放后的 my_value.template，返回 [ind, score, scale]，见 TemplateMatcher.search
+    return my_value.matcher.search(my_value.template, scale=scale, search_num=search_num, levels=levels,
+                                   processes=processes)
 
 
 def estimate_crop_parameters(original_file=None, template_file=None, ori_img=None, tem_img=None
-                             , scale=(0.5, 2), search_num=200):
+                             , scale=(0.5, 2), search_num=200, levels=None, processes=None):
     # 推测攻击后的图片，在原图片中的位置、大小
+    # levels: 金字塔搜索的层数，processes: 并行匹配各个 scale 的线程数，见 TemplateMatcher.search
+    # 缓存只在本次调用中有效；同一张原图要推测多个模板时，用 TemplateMatcher 共用缓存
     if template_file:
         tem_img = cv2.imread(template_file, cv2.IMREAD_GRAYSCALE)  # template image
     if original_file:
         ori_img = cv2.imread(original_file, cv2.IMREAD_GRAYSCALE)  # image
 
-    if scale[0] == scale[1] == 1:
-        # 不缩放
-        scale_infer = 1
-        scores = cv2.matchTemplate(ori_img, tem_img, cv2.TM_CCOEFF_NORMED)
-        ind = np.unravel_index(np.argmax(scores, axis=None), scores.shape)
-        ind, score = ind, scores[ind]
-    else:
-        my_value.set_val(image=ori_img, template=tem_img)
-        ind, score, scale_infer = search_template(scale=scale, search_num=search_num)
-    w, h = int(tem_img.shape[1] * scale_infer), int(tem_img.shape[0] * scale_infer)
-    x1, y1, x2, y2 = ind[1], ind[0], ind[1] + w, ind[0] + h
-    return (x1, y1, x2, y2), ori_img.shape, score, scale_infer
+    return TemplateMatcher(ori_img).estimate(tem_img, scale=scale, search_num=search_num, levels=levels,
+                                             processes=processes)
+
+
+def estimate_originals(tem_img, originals, scale=(0.5, 2), search_num=200, levels=None, processes=None):
+    '''
+    不知道截图来自哪张原图时，在多张原图中分别推测截图的位置，返回每张原图的 estimate_crop_parameters 结果
+    best = max(range(len(results)), key=lambda i: results[i][2]) 即为分数最高的原图
+    :param tem_img: 截图，灰度图
+    :param originals: 原图的列表，灰度图或文件名；文件名在各自的线程中读取，同一时刻只有 processes 张原图在内存中
+        原图比按 scale[0] 缩放后的截图还小时，这张原图的结果为 None
+    :param processes: 同时搜索的原图数，默认使用全部 CPU，每张原图内部不再并行
+    '''
+
+    def estimate_one(original):
+        ori_img = cv2.imread(original, cv2.IMREAD_GRAYSCALE) if isinstance(original, str) else original
+        if ori_img.shape[0] < tem_img.shape[0] * scale[0] or ori_img.shape[1] < tem_img.shape[1] * scale[0]:
+            return None
+        return TemplateMatcher(ori_img).estimate(tem_img, scale=scale, search_num=search_num, levels=levels,
+                                                 processes=1)
+
+    pool = AutoPool(mode='multithreading', processes=processes)
+    try:
+        return pool.map(estimate_one, originals)
+    finally:
+        pool.close()
 
 
 def recover_crop(template_file=None, tem_img=None, output_file_name=None, loc=None, image_o_shape=None):
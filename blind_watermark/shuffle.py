@@ -0,0 +1,92 @@
+import os
+import threading
+
+import numpy as np
+
+from .cache import LRUCache
+
+STRATEGIES = ('v1', 'v2')
+
+
+class ShuffleStream(object):
+    '''
+    按顺序生成每个分块的置换（加密用的打乱顺序），每行是 range(block_shape) 的一个置换
+    next(n) 依次取出接下来 n 个分块的置换，分多次取与一次取完的结果相同（分条处理大图时依赖这一点）
+
+    strategy:
+    'v1': 每个分块独立生成随机置换，与 random_strategy1 相同，是默认值，也是旧版本嵌入的水印使用的策略
+    'v2': 先生成 table_size 个随机置换，每个分块随机选其中一个，不需要对每个分块做 argsort，快很多
+    嵌入和提取必须使用同一个 strategy
+    '''
+    table_size = 4096
+
+    def __init__(self, seed, block_shape, strategy='v1'):
+        assert strategy in STRATEGIES, 'strategy in {}'.format(tuple(STRATEGIES))
+        self.block_shape = block_shape
+        self.strategy = strategy
+        self.rand = np.random.RandomState(seed)
+        self.dtype = np.uint8 if block_shape <= 256 else np.int64
+        if strategy == 'v2':
+            self.table = self.rand.random(size=(self.table_size, block_shape)).argsort(axis=1).astype(self.dtype)
+
+    def next(self, n):
+        if self.strategy == 'v2':
+            return self.table[self.rand.randint(self.table_size, size=n)]
+        return self.rand.random(size=(n, self.block_shape)).argsort(axis=1).astype(self.dtype)
+
+
+class ShuffleProvider(object):
+    '''
+    整张图片的分块置换，按 (strategy, seed, size, block_shape) 缓存
+    同样尺寸的图片反复嵌入/提取时不必重新生成
+    返回的 array 是只读的，所有调用方共用
+    '''
+
+    def __init__(self, max_bytes=256 << 20, cache_dir=None):
+        self.cache = LRUCache(max_bytes=max_bytes)
+        self.cache_dir = cache_dir  # 不为 None 时，同时把置换保存为 .npy 文件，跨进程复用
+        self._lock = threading.Lock()
+
+    def get(self, seed, size, block_shape, strategy='v1'):
+        key = (strategy, seed, size, block_shape)
+        idx_shuffle = self.cache.get(key)
+        if idx_shuffle is not None:
+            return idx_shuffle
+
+        with self._lock:
+            idx_shuffle = self.cache.get(key)
+            if idx_shuffle is not None:
+                return idx_shuffle
+
+            idx_shuffle = self.load(key)
+            if idx_shuffle is None:
+                idx_shuffle = ShuffleStream(seed, block_shape, strategy).next(size)
+                self.save(key, idx_shuffle)
+            idx_shuffle.flags.writeable = False
+            self.cache.put(key, idx_shuffle)
+        return idx_shuffle
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, 'shuffle_{}_{}_{}_{}.npy'.format(*key))
+
+    def load(self, key):
+        if self.cache_dir is None or not os.path.exists(self.filename(key)):
+            return None
+        return np.load(self.filename(key))
+
+    def save(self, key, idx_shuffle):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 先写临时文件再改名，避免并发时读到写了一半的文件
+        tmp_filename = '{}.{}.tmp.npy'.format(self.filename(key)[:-4], os.getpid())
+        np.save(tmp_filename, idx_shuffle)
+        os.replace(tmp_filename, self.filename(key))
+
+    def clear(self):
+        self.cache.clear()
+
+
+# 所有 WaterMarkCore 共用
+# 持久化到磁盘：blind_watermark.shuffle.shuffle_provider.cache_dir = 'path/to/dir'
+shuffle_provider = ShuffleProvider()
@@ -0,0 +1,88 @@
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageStats(object):
+    '''
+    记录 WaterMarkCore 每个阶段的耗时和内存分配
+
+    stats = StageStats(trace_memory=True)
+    bwm = WaterMark(..., stats=stats)
+    bwm.embed(...)
+    print(stats.summary())
+
+    阶段可以嵌套，子阶段的名字是 'parent/child'，它的耗时同时计入父阶段
+    :param callback: 每个阶段结束时调用 callback(record)
+    :param trace_memory: 用 tracemalloc 统计内存分配，会让计算变慢，只在排查问题时打开
+    '''
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []  # 每个阶段一条：{'stage', 'seconds', 'alloc_bytes', 'peak_bytes'}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        # 每个线程各自的阶段栈
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._stack
+        frame = {'stage': '/'.join([i['stage'] for i in stack[-1:]] + [name]),
+                 'start': time.perf_counter(), 'mem_start': None, 'peak': 0}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.update_peak()
+            frame['mem_start'] = tracemalloc.get_traced_memory()[0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            record = {'stage': frame['stage'], 'seconds': time.perf_counter() - frame['start'],
+                      'alloc_bytes': None, 'peak_bytes': None}
+            if frame['mem_start'] is not None and tracemalloc.is_tracing():
+                self.update_peak(frame)
+                current = tracemalloc.get_traced_memory()[0]
+                record['alloc_bytes'] = current - frame['mem_start']
+                record['peak_bytes'] = max(frame['peak'], current) - frame['mem_start']
+            with self._lock:
+                self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def update_peak(self, *frames):
+        # tracemalloc 只有一个全局峰值，每次读取后清零，再把读到的峰值记到栈上所有阶段
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self._stack + list(frames):
+            frame['peak'] = max(frame['peak'], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def summary(self):
+        # 按阶段汇总：{stage: {'count', 'seconds', 'alloc_bytes', 'peak_bytes'}}
+        result = OrderedDict()
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            item = result.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'alloc_bytes': None,
+                                                       'peak_bytes': None})
+            item['count'] += 1
+            item['seconds'] += record['seconds']
+            if record['alloc_bytes'] is not None:
+                item['alloc_bytes'] = (item['alloc_bytes'] or 0) + record['alloc_bytes']
+                item['peak_bytes'] = max(item['peak_bytes'] or 0, record['peak_bytes'])
+        return result
+
+    def clear(self):
+        with self._lock:
+            self.records = []
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# coding=utf-8
+'''
+攻击鲁棒性验证：对打好水印的图片做一组攻击（全部在内存中，不写文件），用进程池并行提取水印，给出每种攻击的误码率
+
+with Verifier(processes=4) as verifier:
+    report = verifier.verify(embed_img, wm_bit, password_wm=1, password_img=1, block_size=4, resist=35)
+    print(all(item['ber'] == 0 for item in report))
+
+攻击是 (name, func)，func(input_img=img) 返回攻击后的图片，需要能 pickle：att 中的函数、functools.partial、
+att.AttackChain 或模块级函数
+'''
+import time
+from functools import partial
+
+import numpy as np
+
+from . import att
+from .blind_watermark import WaterMark
+from .pool import AutoPool, SharedArray
+from .recover import recover_crop
+from .version import bw_notes
+
+
+def crop_scale_recover(input_img, loc_r=((0.1, 0.1), (0.5, 0.5)), scale=0.7):
+    # 剪切 + 缩放，再按已知的参数还原到原图的位置
+    h, w = input_img.shape[:2]
+    loc = int(w * loc_r[0][0]), int(h * loc_r[0][1]), int(w * loc_r[1][0]), int(h * loc_r[1][1])
+    output_img = att.cut_att3(input_img=input_img, loc=loc, scale=scale)
+    return recover_crop(tem_img=output_img, loc=loc, image_o_shape=(h, w))
+
+
+def resize_recover(input_img, out_shape=(800, 600)):
+    # 缩放后再缩放回原来的大小
+    h, w = input_img.shape[:2]
+    return att.resize_att(input_img=att.resize_att(input_img=input_img, out_shape=out_shape), out_shape=(w, h))
+
+
+# 默认的攻击，与 cmd 中 --verify 的测试用例相同，随机的攻击固定了 rng，结果可复现
+DEFAULT_ATTACKS = [
+    ('crop', partial(att.cut_att, loc=((0.3, 0.1), (0.7, 0.9)))),
+    ('crop_scale_recover', crop_scale_recover),
+    ('salt_pepper', partial(att.salt_pepper_att, ratio=0.05, rng=0)),
+    ('resize_recover', resize_recover),
+]
+
+# 更强的攻击，大多数参数下都不能完整还原
+EXTRA_ATTACKS = [
+    ('rotate_recover', att.AttackChain(partial(att.rot_att, angle=45), partial(att.rot_att, angle=-45))),
+    ('cover', partial(att.shelter_att, ratio=0.1, n=60, rng=0)),
+]
+
+
+def verify_worker(args):
+    # 在子进程中：攻击 -> 提取 -> 误码率
+    # embed_img 在 multiprocessing 模式下是共享内存的 (shape, dtype, name)，每个任务各自挂载、各自关闭
+    name, attack, embed_img, wm_bit, wm_kwargs = args
+    bw_notes.close()
+    result = {'attack': name, 'ber': None, 'seconds': None, 'error': None}
+    t = time.perf_counter()
+    shared = SharedArray(*embed_img) if isinstance(embed_img, tuple) else None
+    try:
+        img = attack(input_img=(embed_img if shared is None else shared.array).copy())
+        bwm = WaterMark(**wm_kwargs)
+        wm_extract = bwm.extract(embed_img=np.asarray(img)[:, :, :3], wm_shape=wm_bit.size, mode='bit')
+        result['ber'] = float(np.mean(wm_extract != wm_bit))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if shared is not None:
+            shared.close()
+    result['seconds'] = time.perf_counter() - t
+    return result
+
+
+class Verifier:
+    '''
+    :param attacks: [(name, func), ...]，默认 DEFAULT_ATTACKS
+    :param processes: 进程数，默认使用全部 CPU
+    :param mode: 'multiprocessing'，或者 'multithreading'/'common'（在当前进程中计算）
+    多个线程可以共用同一个 Verifier，任务都提交到同一个进程池
+    '''
+
+    def __init__(self, attacks=None, processes=None, mode='multiprocessing'):
+        self.attacks = DEFAULT_ATTACKS if attacks is None else list(attacks)
+        self.pool = AutoPool(mode=mode, processes=processes)
+
+    def verify(self, embed_img, wm_bit, **wm_kwargs):
+        '''
+        :param embed_img: 打好水印的图片，与写入 png 再读回相同，先取整到 uint8
+        :param wm_bit: 嵌入的水印，一维 bit 数组，与 WaterMark.read_wm(wm_bit, mode='bit') 相同
+        :param wm_kwargs: 提取时 WaterMark 的参数，例如 password_wm、password_img、block_size、resist，
+            mode 默认是 'vectorization'
+        :return: 每种攻击一个 dict：{'attack', 'ber', 'seconds', 'error'}，出错时 ber 为 None
+        '''
+        return self.verify_many([(embed_img, wm_bit, wm_kwargs)])[0]
+
+    def verify_many(self, jobs):
+        # jobs: [(embed_img, wm_bit, wm_kwargs), ...]，全部攻击一起提交到进程池，返回每个 job 的结果
+        shared, tasks = [], []
+        try:
+            for embed_img, wm_bit, wm_kwargs in jobs:
+                img = np.clip(np.round(embed_img[:, :, :3]), 0, 255).astype(np.uint8)
+                if self.pool.shared_memory:
+                    # 图片放在共享内存里，每个任务只 pickle 共享内存的名字
+                    shared.append(SharedArray.copy_of(img))
+                    img = (shared[-1].shape, shared[-1].dtype.str, shared[-1].shm.name)
+                wm_kwargs = dict({'mode': 'vectorization'}, **wm_kwargs)
+                tasks.extend((name, attack, img, np.asarray(wm_bit).astype(bool), wm_kwargs)
+                             for name, attack in self.attacks)
+            results = self.pool.map(verify_worker, tasks)
+        finally:
+            for shared_array in shared:
+                shared_array.close()
+
+        n = len(self.attacks)
+        return [results[i * n:(i + 1) * n] for i in range(len(jobs))]
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def verify(embed_img, wm_bit, attacks=None, processes=None, **wm_kwargs):
+    # 只验证一张图片时的快捷方式
+    with Verifier(attacks=attacks, processes=processes) as verifier:
+        return verifier.verify(embed_img, wm_bit, **wm_kwargs)
@@ -1,9 +1,9 @@
+import argparse
 import csv
 import os
 from prettytable import PrettyTable
 import logging
-import threading
-from helpers import Helpers
+from helpers import Helpers, TaskExecutor
 import blind_watermark
 
 from email.mime.multipart import MIMEMultipart
@@ -32,10 +32,15 @@ class Colors:
     RESET = '\033[0m'
 
 class Encoder:
-    def __init__(self, workdir = '_encode', wm_bit_len = 128):
+    # 一个任务最多编码同一张原图的 ENCODE_CHUNK 个水印
+    ENCODE_CHUNK = 8
+
+    def __init__(self, workdir = '_encode', wm_bit_len = 128, workers = None, max_pending = None):
         self.workdir = workdir
         self.wm_bit_len = wm_bit_len
-        self.preview_sem = threading.Semaphore(6)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
 
         # inline data
         self.src_images = []
@@ -75,6 +80,14 @@ class Encoder:
         self.resists = [35] * len(src_images)
         self.encoded = [{} for _ in range(len(self.src_images))]
 
+        try:
+            self.__loop()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+    def __loop(self):
         while True:
             user_input = input('''
 输入命令对应的序号，比如输入1表示查看当前状态
@@ -195,18 +208,22 @@ class Encoder:
         block_size_list = [4, 8, 16]
         resist_list = [25, 30, 35]
 
-        verify_results = [list] * len(self.src_images)
-        def preview_image_thread(image_id):
-            verify_results[image_id] = self.__preview_image(image_id, block_size_list, resist_list)
-
-        preview_threads = []
+        # 每张原图的每组 (block_size, resist) 是一个任务
+        wm = '180831502'
+        wm_bit = Helpers.encode_wm(wm, self.wm_bit_len)
+        tasks = []
         for i, image in enumerate(self.src_images):
-            thread = threading.Thread(target=preview_image_thread, args=(i,))
-            thread.start()
-            preview_threads.append(thread)
-
-        for thread in preview_threads:
-            thread.join()
+            preview_dir = self.__preview_image_dir_path(i)
+            os.makedirs(preview_dir, 0o777, exist_ok=True)
+            for b in block_size_list:
+                for r in resist_list:
+                    target = os.path.join(preview_dir, '{:d}-{:d}.png'.format(b, r))
+                    tasks.append((image, [target], self.password, [wm_bit], [wm], self.wm_bit_len, b, r))
+
+        results = self.__get_executor().map(Helpers.encode_and_verify, tasks, name='preview')
+        n = len(block_size_list) * len(resist_list)
+        verify_results = [[result is not None and result[0] for result in results[i * n:(i + 1) * n]]
+                          for i in range(len(self.src_images))]
 
         headers = ['image']
         for block_size in block_size_list:
@@ -241,37 +258,31 @@ class Encoder:
 
 
     def __cmd_encode_all_images(self):
-        encode_sem = threading.Semaphore(6)
-        def encode_thread(image_id, watermark):
-            with encode_sem:
-                target = self.__target_image_path(image_id, watermark)
-                wm_bit = self.__encode_wm(watermark)
-                b = int(self.block_sizes[image_id])
-                r = int(self.resists[image_id])
-
-                logging.info(f'generating {target} ...')
-                Helpers.encode_image(self.src_images[image_id], target, self.password, wm_bit, b, r)
-                logging.info(f'generated {target}')
-
-                verify_dir = os.path.join(self.__target_watermark_dir_path(watermark), 'verify', str(b) + '-' + str(r))
-                ok = Helpers.verify_image(target, watermark, self.password, self.wm_bit_len, b, r, verify_dir)
-                if ok:
-                    self.encoded[image_id][watermark] = True
-                else:
-                    logging.warning(f'target verify FAIL: {target}, have to change block_size or resist')
-
-        threads = []
+        # 同一张原图的水印每 ENCODE_CHUNK 个一次编码，原图只分解一次，编码后在同一个任务中验证
+        tasks, jobs = [], []
         for i, image in enumerate(self.src_images):
+            watermarks = []
             for wm in self.watermarks:
                 if self.__is_encoded(i, wm):
                     logging.info(f'SKIP {self.__target_image_path(i, wm)}')
                 else:
-                    thread = threading.Thread(target=encode_thread, args=(i, wm))
-                    thread.start()
-                    threads.append(thread)
-
-        for thread in threads:
-            thread.join()
+                    watermarks.append(wm)
+            b = int(self.block_sizes[i])
+            r = int(self.resists[i])
+            for start in range(0, len(watermarks), self.ENCODE_CHUNK):
+                chunk = watermarks[start:start + self.ENCODE_CHUNK]
+                targets = [self.__target_image_path(i, watermark) for watermark in chunk]
+                wm_bits = [self.__encode_wm(watermark) for watermark in chunk]
+                tasks.append((image, targets, self.password, wm_bits, chunk, self.wm_bit_len, b, r))
+                jobs.append((i, chunk, targets))
+
+        results = self.__get_executor().map(Helpers.encode_and_verify, tasks, name='encode')
+        for (image_id, watermarks, targets), oks in zip(jobs, results):
+            for watermark, target, ok in zip(watermarks, targets, oks or [False] * len(targets)):
+                if ok:
+                    self.encoded[image_id][watermark] = True
+                else:
+                    logging.warning(f'target verify FAIL: {target}, have to change block_size or resist')
 
 
     def __cmd_send_email(self):
@@ -392,6 +403,13 @@ class Encoder:
         return msg
 
 
+    def __get_executor(self):
+        # 所有命令共用一个进程池，第一次用到时创建
+        if self.executor is None:
+            self.executor = TaskExecutor(workers=self.workers, max_pending=self.max_pending)
+        return self.executor
+
+
     def __encode_wm(self, watermark):
         return Helpers.encode_wm(watermark, self.wm_bit_len)
 
@@ -409,47 +427,6 @@ class Encoder:
 
 
 
-    def __preview_image(self, i, block_size_list, resist_list):
-        image = self.src_images[i]
-        preview_dir = self.__preview_image_dir_path(i)
-
-        os.makedirs(preview_dir, 0o777, exist_ok=True)
-
-        target_list = [''] * len(block_size_list) * len(resist_list)
-        result_list = [0] * len(block_size_list) * len(resist_list)
-
-        wm = '180831502'
-        wm_bit = Helpers.encode_wm(wm, self.wm_bit_len)
-        def preview_func(b, r, idx):
-            with self.preview_sem:
-                target = os.path.join(preview_dir, '{:d}-{:d}.png'.format(b, r))
-                target_list[idx] = target
-                logging.info(f'generating {target}...')
-                Helpers.encode_image(image, target, self.password, wm_bit, b, r)
-                logging.info(f'generated {target}')
-
-                verify_dir = os.path.join(preview_dir, 'verify', str(b) + '-' + str(r))
-                result_list[idx] = Helpers.verify_image(target, wm, self.password, self.wm_bit_len, b, r, verify_dir)
-
-        block_size_args = []
-        resist_args = []
-        for block_size in block_size_list:
-            for resist in resist_list:
-                block_size_args.append(block_size)
-                resist_args.append(resist)
-
-        threads = []
-        for i, block_size in enumerate(block_size_args):
-            thread = threading.Thread(target=preview_func, args=(block_size_args[i], resist_args[i], i))
-            thread.start()
-            threads.append(thread)
-
-        for thread in threads:
-            thread.join()
-
-        return result_list
-
-
     @staticmethod
     def __is_password_valid(password):
         return str(password).isalnum()
@@ -489,7 +466,12 @@ class Encoder:
         return os.path.join(self.__archive_path(), watermark+'.tgz')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='encode processes, default: all CPUs')
+    parser.add_argument('--max-pending', type=int, default=None, help='max queued tasks, default: 2 * workers')
+    args = parser.parse_args()
+
     blind_watermark.bw_notes.close()
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
-    Encoder().run()
+    Encoder(workers=args.workers, max_pending=args.max_pending).run()
@@ -1,17 +1,21 @@
 import time
 from threading import ThreadError
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import os
 import cv2
 import logging
 
+import blind_watermark
 from blind_watermark import WaterMark
-from blind_watermark import att
-from blind_watermark.recover import recover_crop
+from blind_watermark.verify import Verifier
 import threading
 
 class Helpers:
+    verifier = None
+    verifier_lock = threading.Lock()
+
     @staticmethod
     def encode_wm(wm, wm_bit_len=0):
         byte = bin(int(wm.encode('utf-8').hex(), base=16))[2:]
@@ -30,72 +34,134 @@ class Helpers:
         return byte_seq.decode('utf-8')
 
     @staticmethod
-    def encode_image(src=None, target=None, pwd=None, wm=None, block_size=16, resist=25):
-        bwm = WaterMark(password_img=int(pwd), password_wm=int(pwd), resist=resist, block_size=block_size)
+    def encode_image(src=None, target=None, pwd=None, wm=None, block_size=16, resist=25, channels='YUV'):
+        # 在 TaskExecutor 的进程中运行，每个任务只读一次原图；不用 'cached'，每个进程各自的缓存只会占着内存
+        bwm = WaterMark(password_img=int(pwd), password_wm=int(pwd), resist=resist, block_size=block_size,
+                        mode='vectorization', channels=channels)
         bwm.read_img(src)
         bwm.read_wm(wm, mode='bit')
         bwm.embed(target)
 
     @staticmethod
-    def decode_image(src=None, pwd=None, wm_bit_len=None, block_size=16, resist=25):
-        bwm = WaterMark(password_img=int(pwd), password_wm=int(pwd), resist=resist, block_size=block_size)
+    def encode_image_many(src=None, targets=None, pwd=None, wms=None, block_size=16, resist=25, channels='YUV'):
+        # embed_many 本身只分解一次原图，同样不需要缓存
+        bwm = WaterMark(password_img=int(pwd), password_wm=int(pwd), resist=resist, block_size=block_size,
+                        mode='vectorization', channels=channels)
+        bwm.read_img(src)
+        bwm.embed_many(wms, filenames=targets, mode='bit')
+
+    @staticmethod
+    def decode_image(src=None, pwd=None, wm_bit_len=None, block_size=16, resist=25, channels='YUV'):
+        bwm = WaterMark(password_img=int(pwd), password_wm=int(pwd), resist=resist, block_size=block_size,
+                        channels=channels)
         wm_bit = bwm.extract(filename=src, wm_shape=wm_bit_len, mode='bit')
         wm = Helpers.decode_wm(wm_bit)
         return wm
 
     @staticmethod
-    def verify_image(image, expected, pwd, wm_bit_len, block_size, resist, verify_dir='_verify'):
-        os.makedirs(verify_dir, 0o777, exist_ok=True)
-
-        testcases = [
-            os.path.join(verify_dir, 'crop.png'),
-            os.path.join(verify_dir, 'crop_scale_recover.png'),
-            os.path.join(verify_dir, 'salt_pepper.png'),
-            # os.path.join(verify_dir, 'rotate_recover.png'),
-            # os.path.join(verify_dir, 'cover.png'),
-            os.path.join(verify_dir, 'resize_recover.png'),
-        ]
-
-        # testcase 0
-        att.cut_att(input_filename=image, output_file_name=testcases[0], loc=((0.3, 0.1), (0.7, 0.9)))
-
-        # testcase 1
-        ori_img_shape = cv2.imread(image).shape[:2]
-        h, w = ori_img_shape
-        loc_r = ((0.1, 0.1), (0.5, 0.5))
-        scale = 0.7
-        x1, y1, x2, y2 = int(w * loc_r[0][0]), int(h * loc_r[0][1]), int(w * loc_r[1][0]), int(h * loc_r[1][1])
-        tmp_file = os.path.join(verify_dir, 'crop_scale.png')
-        att.cut_att3(input_filename=image, output_file_name=tmp_file, loc=(x1, y1, x2, y2), scale=scale)
-        recover_crop(template_file=tmp_file, output_file_name=testcases[1], loc=(x1, y1, x2, y2),
-                     image_o_shape=ori_img_shape)
-
-        # testcase 2
-        att.salt_pepper_att(input_filename=image, output_file_name=testcases[2], ratio=0.05)
-
-        # testcase 3
-        # tmp_file = os.path.join(verify_dir, 'rotate.png')
-        # att.rot_att(input_filename=image, output_file_name=tmp_file, angle=45)
-        # att.rot_att(input_filename=tmp_file, output_file_name=testcases[3], angle=-45)
-
-        # testcase 4
-        # att.shelter_att(input_filename=image, output_file_name=testcases[4], ratio=0.1, n=60)
-
-        # testcase 5
-        tmp_file = os.path.join(verify_dir, 'resize.png')
-        att.resize_att(input_filename=image, output_file_name=tmp_file, out_shape=(800, 600))
-        att.resize_att(input_filename=tmp_file, output_file_name=testcases[3], out_shape=ori_img_shape[::-1])
-
-        for testcase in testcases:
-            try:
-                wm = Helpers.decode_image(testcase, pwd, wm_bit_len, block_size, resist)
-            except ValueError as e:
-                logging.error(f'verify FAIL, testcase: {testcase:s}, failed to decode watermark: {e}')
+    def encode_and_verify(src, targets, pwd, wm_bits, expected, wm_bit_len, block_size, resist, channels='YUV',
+                          verify=True):
+        # TaskExecutor 的一个任务：同一张原图的一组水印一次编码，再逐个验证，返回每个 target 是否通过验证
+        Helpers.encode_image_many(src, targets, pwd, wm_bits, block_size, resist, channels)
+        logging.info(f'generated {", ".join(targets)}')
+        if not verify:
+            return [True] * len(targets)
+        return [Helpers.verify_image(target, wm, pwd, wm_bit_len, block_size, resist, channels)
+                for target, wm in zip(targets, expected)]
+
+    @staticmethod
+    def init_worker():
+        # TaskExecutor 中的每个进程：进程池已经占满了 CPU，验证时直接在本进程中计算，不再另起进程池
+        blind_watermark.bw_notes.close()
+        Helpers.verifier = Verifier(mode='common')
+
+    @staticmethod
+    def get_verifier():
+        # 所有线程共用一个 Verifier，验证任务都提交到同一个进程池
+        with Helpers.verifier_lock:
+            if Helpers.verifier is None:
+                Helpers.verifier = Verifier()
+            return Helpers.verifier
+
+    @staticmethod
+    def verify_image(image, expected, pwd, wm_bit_len, block_size, resist, channels='YUV'):
+        # 攻击都在内存中进行，各个测试用例并行提取
+        embed_img = cv2.imread(image)
+        report = Helpers.get_verifier().verify(embed_img, Helpers.encode_wm(expected, wm_bit_len),
+                                               password_wm=int(pwd), password_img=int(pwd),
+                                               block_size=block_size, resist=resist, channels=channels)
+        for item in report:
+            if item['error'] is not None:
+                logging.error(f'verify FAIL, testcase: {item["attack"]:s}, failed to decode watermark: {item["error"]}')
                 return False
 
-            if wm != expected:
-                logging.error(f'verify FAIL, testcase: {testcase:s}, expected {expected:s}, decode {wm:s}')
+            if item['ber'] > 0:
+                logging.error(f'verify FAIL, testcase: {item["attack"]:s}, expected {expected:s}, '
+                              f'bit error rate {item["ber"]:.4f}')
                 return False
-            logging.info(f'testcase ok: {testcase:s}')
+            logging.info(f'testcase ok: {item["attack"]:s}')
         logging.info(f'verify PASS, image: {image:s}')
-        return True
\ No newline at end of file
+        return True
+
+
+class Progress:
+    # 每完成一个任务打印一次进度和预计剩余时间，可以在多个线程中调用
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def update(self, _future=None):
+        with self.lock:
+            self.done += 1
+            elapsed = time.perf_counter() - self.start
+            eta = elapsed / self.done * (self.total - self.done)
+            logging.info(f'{self.name}: {self.done}/{self.total}, elapsed {elapsed:.0f}s, ETA {eta:.0f}s')
+
+
+class TaskExecutor:
+    '''
+    大小固定的进程池，所有命令共用。最多 max_pending 个任务在排队或计算中，再提交时阻塞，等前面的任务完成（背压）
+    :param workers: 进程数，默认使用全部 CPU
+    :param max_pending: 默认是 workers 的 2 倍
+    '''
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=Helpers.init_worker)
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def map(self, fn, tasks, name='tasks'):
+        # 依次提交 tasks（每个是 fn 的参数元组），打印进度，按提交顺序返回结果，出错的任务结果为 None
+        tasks = list(tasks)
+        progress = Progress(name, len(tasks))
+        futures = []
+        for args in tasks:
+            future = self.submit(fn, *args)
+            future.add_done_callback(progress.update)
+            futures.append(future)
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error(f'{name} task failed: {type(e).__name__}: {e}')
+                results.append(None)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown()
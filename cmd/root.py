@@ -6,8 +6,7 @@ import csv
 import logging
 
 from blind_watermark import WaterMark
-from blind_watermark import att
-from blind_watermark.recover import recover_crop
+from blind_watermark.verify import Verifier, DEFAULT_ATTACKS, EXTRA_ATTACKS
 
 from email.mime.multipart import MIMEMultipart
 from smtplib import SMTP_SSL
@@ -31,6 +30,7 @@ DECODE_KEY_PASSWORD = 'password'
 DECODE_KEY_WATERMARK_BIT_LEN = 'wm_bit_len'
 DECODE_KEY_BLOCK_SIZE = 'block_size'
 DECODE_KEY_RESIST = 'resist'
+DECODE_KEY_CHANNELS = 'channels'
 BATCH_SRC_FILE = 'src.png'
 BATCH_SAVE_FILE = 'save.csv'
 BATCH_SAVE_FILE_HEADERS = [
@@ -38,8 +38,12 @@ BATCH_SAVE_FILE_HEADERS = [
     DECODE_KEY_WATERMARK_BIT_LEN,
     DECODE_KEY_BLOCK_SIZE,
     DECODE_KEY_RESIST,
+    DECODE_KEY_CHANNELS,
 ]
 
+# --verify 用的 Verifier，第一次用到时创建
+verifier = None
+
 
 def encode_wm(wm, wm_bit_len=0):
     byte = bin(int(wm.encode('utf-8').hex(), base=16))[2:]
@@ -58,21 +62,29 @@ def decode_wm(wm_bit):
     return byte_seq.decode('utf-8')
 
 
-def encode_image(src=None, target=None, pwd=None, wm=None, block_size=16, resist=25):
-    bwm = WaterMark(password_img=pwd, password_wm=pwd, resist=resist, block_size=block_size)
+def encode_image(src=None, target=None, pwd=None, wm=None, block_size=16, resist=25, channels='YUV'):
+    bwm = WaterMark(password_img=pwd, password_wm=pwd, resist=resist, block_size=block_size,
+                    mode='cached', channels=channels)
     bwm.read_img(src)
     bwm.read_wm(wm, mode='bit')
     bwm.embed(target)
 
 
-def decode_image(src=None, pwd=None, wm_bit_len=None, block_size=16, resist=25):
-    bwm = WaterMark(password_img=pwd, password_wm=pwd, resist=resist, block_size=block_size)
+def encode_image_many(src=None, targets=None, pwd=None, wms=None, block_size=16, resist=25, channels='YUV'):
+    bwm = WaterMark(password_img=pwd, password_wm=pwd, resist=resist, block_size=block_size,
+                    mode='cached', channels=channels)
+    bwm.read_img(src)
+    bwm.embed_many(wms, filenames=targets, mode='bit')
+
+
+def decode_image(src=None, pwd=None, wm_bit_len=None, block_size=16, resist=25, channels='YUV'):
+    bwm = WaterMark(password_img=pwd, password_wm=pwd, resist=resist, block_size=block_size, channels=channels)
     wm_bit = bwm.extract(filename=src, wm_shape=wm_bit_len, mode='bit')
     wm = decode_wm(wm_bit)
     return wm
 
 
-def preview_image(image, password, wm, verify, expected):
+def preview_image(image, password, wm, verify, expected, channels='YUV'):
     preview_dir = '_preview'
     block_size_list = [4, 8, 16]
     resist_list = [20, 25, 30, 35, 40]
@@ -81,66 +93,36 @@ def preview_image(image, password, wm, verify, expected):
     for block_size in block_size_list:
         for resist in resist_list:
             target = os.path.join(preview_dir, str(block_size)+'-'+str(resist)+'-'+basename)
-            encode_image(image, target, password, wm, block_size, resist)
+            encode_image(image, target, password, wm, block_size, resist, channels)
             if verify:
-                ok = verify_image(target, expected, password, wm.size, block_size, resist)
+                ok = verify_image(target, expected, password, wm.size, block_size, resist, channels)
                 if ok:
                     logging.info('PASS: ', target)
                 else:
                     logging.warning('FAIL: ', target)
 
 
-def verify_image(image, expected, pwd, wm_bit_len, block_size, resist):
-    verify_dir = '_verify'
-    os.makedirs(verify_dir, 0o777, exist_ok=True)
-
-    testcases = [
-        os.path.join(verify_dir, 'crop.png'),
-        os.path.join(verify_dir, 'crop_scale_recover.png'),
-        os.path.join(verify_dir, 'salt_pepper.png'),
-        os.path.join(verify_dir, 'rotate_recover.png'),
-        os.path.join(verify_dir, 'cover.png'),
-        os.path.join(verify_dir, 'resize_recover.png'),
-    ]
-
-    # testcase 0
-    att.cut_att(input_filename=image, output_file_name=testcases[0], loc=((0.3, 0.1), (0.7, 0.9)))
-
-    # testcase 1
-    ori_img_shape = cv2.imread(image).shape[:2]
-    h, w = ori_img_shape
-    loc_r = ((0.1, 0.1), (0.5, 0.5))
-    scale = 0.7
-    x1, y1, x2, y2 = int(w * loc_r[0][0]), int(h * loc_r[0][1]), int(w * loc_r[1][0]), int(h * loc_r[1][1])
-    tmp_file = os.path.join(verify_dir, 'crop_scale.png')
-    att.cut_att3(input_filename=image, output_file_name=tmp_file, loc=(x1, y1, x2, y2), scale=scale)
-    recover_crop(template_file=tmp_file, output_file_name=testcases[1], loc=(x1, y1, x2, y2), image_o_shape=ori_img_shape)
-
-    # testcase 2
-    att.salt_pepper_att(input_filename=image, output_file_name=testcases[2], ratio=0.05)
-
-    # testcase 3
-    tmp_file = os.path.join(verify_dir, 'rotate.png')
-    att.rot_att(input_filename=image, output_file_name=tmp_file, angle=45)
-    att.rot_att(input_filename=tmp_file, output_file_name=testcases[3], angle=-45)
-
-    # testcase 4
-    att.shelter_att(input_filename=image, output_file_name=testcases[4], ratio=0.1, n=60)
-
-    # testcase 5
-    tmp_file = os.path.join(verify_dir, 'resize.png')
-    att.resize_att(input_filename=image, output_file_name=tmp_file, out_shape=(800, 600))
-    att.resize_att(input_filename=tmp_file, output_file_name=testcases[5], out_shape=ori_img_shape[::-1])
-
-    for testcase in testcases:
-        try:
-            wm = decode_image(testcase, pwd, wm_bit_len, block_size, resist)
-        except ValueError as e:
-            logging.error(f'failed to decode watermark: {e}')
+def get_verifier():
+    # 所有 --verify 共用一个进程池
+    global verifier
+    if verifier is None:
+        verifier = Verifier(attacks=DEFAULT_ATTACKS + EXTRA_ATTACKS)
+    return verifier
+
+
+def verify_image(image, expected, pwd, wm_bit_len, block_size, resist, channels='YUV'):
+    # 攻击都在内存中进行，各个测试用例并行提取
+    embed_img = cv2.imread(image)
+    report = get_verifier().verify(embed_img, encode_wm(expected, wm_bit_len), password_wm=int(pwd),
+                                   password_img=int(pwd), block_size=block_size, resist=resist, channels=channels)
+    for item in report:
+        if item['error'] is not None:
+            logging.error(f'failed to decode watermark, testcase: {item["attack"]:s}, {item["error"]}')
             return False
 
-        if wm != expected:
-            logging.error(f'verify failed, testcase: {testcase:s}, expected {expected:s}, decode {wm:s}')
+        if item['ber'] > 0:
+            logging.error(f'verify failed, testcase: {item["attack"]:s}, expected {expected:s}, '
+                          f'bit error rate {item["ber"]:.4f}')
             return False
     return True
 
@@ -162,10 +144,11 @@ def root(ctx, wm_bit_len):
 @click.option('-o', '--output', show_default=True, default='output.png')
 @click.option('--block-size', show_default=True, default=4)
 @click.option('--resist', show_default=True, default=35)
+@click.option('--channels', show_default=True, default='YUV', help='YUV channels to embed into, like Y or UV')
 @click.option('--verify', show_default=True, default=False, is_flag=True, help='try to decoded image')
 @click.option('--preview', show_default=True, default=False, is_flag=True, help='show encoded images with a group of block-size/resist')
 @click.pass_context
-def encode(ctx, image, wm, password, output, block_size, resist, verify, preview):
+def encode(ctx, image, wm, password, output, block_size, resist, channels, verify, preview):
     wm_bit_len = ctx.obj[LABEL_WM_BIT_LEN]
     wm_bit = encode_wm(wm, wm_bit_len)
     logging.info(f'watermark (string): {wm}')
@@ -175,12 +158,12 @@ def encode(ctx, image, wm, password, output, block_size, resist, verify, preview
         logging.warning(f'watermark bits length {wm_bit.size:d} exceed wm_bit_len {wm_bit_len:d}')
 
     if preview:
-        preview_image(image, password, wm_bit, verify, wm)
+        preview_image(image, password, wm_bit, verify, wm, channels)
         return
 
-    encode_image(image, output, int(password), wm_bit, block_size, resist)
+    encode_image(image, output, int(password), wm_bit, block_size, resist, channels)
     if verify:
-        ok = verify_image(output, wm, password, wm_bit.size, block_size, resist)
+        ok = verify_image(output, wm, password, wm_bit.size, block_size, resist, channels)
         if not ok:
             logging.error('image verify failed, please try other arguments')
             return
@@ -191,6 +174,7 @@ def encode(ctx, image, wm, password, output, block_size, resist, verify, preview
     logging.info(f'wm_bit_len:   {wm_bit.size}')
     logging.info(f'block_size: {block_size}')
     logging.info(f'resist:     {resist}')
+    logging.info(f'channels:   {channels}')
 
 
 @root.command()
@@ -198,10 +182,11 @@ def encode(ctx, image, wm, password, output, block_size, resist, verify, preview
 @click.option('-p', '--password', show_default=True, default=1)
 @click.option('--block-size', show_default=True, default=4)
 @click.option('--resist', show_default=True, default=35)
+@click.option('--channels', show_default=True, default='YUV', help='YUV channels to embed into, like Y or UV')
 @click.pass_context
-def decode(ctx, image, password, block_size, resist):
+def decode(ctx, image, password, block_size, resist, channels):
     wm_bit_len = ctx.obj[LABEL_WM_BIT_LEN]
-    wm = decode_image(image, password, wm_bit_len, block_size, resist)
+    wm = decode_image(image, password, wm_bit_len, block_size, resist, channels)
     logging.info(f'success decode from {image}: {wm}')
 
 
@@ -242,6 +227,8 @@ def batch_read_csv(filename):
                 row[DECODE_KEY_WATERMARK_BIT_LEN],
                 row[DECODE_KEY_BLOCK_SIZE],
                 row[DECODE_KEY_RESIST],
+                # 没有 channels 列的旧 csv，嵌入时用的是全部通道
+                row[DECODE_KEY_CHANNELS] or 'YUV',
             ]
             data.append(line)
     return data
@@ -283,9 +270,10 @@ In batch, all encoded watermark could not be longer than wm_bit_len
 @click.option('-p', '--password', show_default=True, default=1)
 @click.option('--block-size', show_default=True, default=4)
 @click.option('--resist', show_default=True, default=35)
+@click.option('--channels', show_default=True, default='YUV', help='YUV channels to embed into, like Y or UV')
 @click.option('--verify', show_default=True, default=False, is_flag=True, help='try to decoded image')
 @click.pass_context
-def batch_encode(ctx, batch_dir, csv_file, image_id, force, password, block_size, resist, verify):
+def batch_encode(ctx, batch_dir, csv_file, image_id, force, password, block_size, resist, channels, verify):
     os.makedirs(batch_dir, 0o777, exist_ok=True)
 
     # serialisation images
@@ -309,6 +297,7 @@ def batch_encode(ctx, batch_dir, csv_file, image_id, force, password, block_size
             reader = csv.DictReader(file, fieldnames=[BATCH_INPUT_WATERMARK])
             next(reader)
 
+            pending = []
             for row in reader:
                 wm = row[BATCH_INPUT_WATERMARK]
                 target = os.path.join(image_dir, wm + '.png')
@@ -327,15 +316,20 @@ def batch_encode(ctx, batch_dir, csv_file, image_id, force, password, block_size
                     logging.error(f'watermark {wm} has encoded length {wm_bit.size} exceed wm_bit_len {wm_bit_len}, '
                                   f'please try other encode arguments and re-do this batch')
                     return
+                pending.append((wm, target, wm_bit))
 
-                encode_image(image_file, target, int(password), wm_bit, block_size, resist)
-                if verify:
-                    ok = verify_image(target, wm, password, wm_bit.size, block_size, resist)
-                    if not ok:
-                        logging.error(f'watermark {wm} cannot pass verification, '
-                                      f'please try other encode arguments and re-do this batch')
-                        return
-                logging.info(f'success: {target}')
+        # 同一张原图的所有水印一次编码，原图只分解一次
+        if len(pending) > 0:
+            encode_image_many(image_file, [target for _, target, _ in pending], int(password),
+                              [wm_bit for _, _, wm_bit in pending], block_size, resist, channels)
+        for wm, target, wm_bit in pending:
+            if verify:
+                ok = verify_image(target, wm, password, wm_bit.size, block_size, resist, channels)
+                if not ok:
+                    logging.error(f'watermark {wm} cannot pass verification, '
+                                  f'please try other encode arguments and re-do this batch')
+                    return
+            logging.info(f'success: {target}')
 
         save_file = os.path.join(image_dir, 'save.csv')
         if os.path.exists(save_file) and not force:
@@ -343,8 +337,8 @@ def batch_encode(ctx, batch_dir, csv_file, image_id, force, password, block_size
             continue
         with open(save_file, mode='w', encoding='utf-8', newline='') as file:
             writer = csv.writer(file)
-            writer.writerow(['password', 'wm_bit_len', 'block_size', 'resist'])
-            writer.writerow([password, ctx.obj[LABEL_WM_BIT_LEN], block_size, resist])
+            writer.writerow(BATCH_SAVE_FILE_HEADERS)
+            writer.writerow([password, ctx.obj[LABEL_WM_BIT_LEN], block_size, resist, channels])
 
     batch_reduce(batch_dir)
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+demonstrate the asyncio API: embed and extract encoded images (bytes) on a process pool, without blocking the event loop
+'''
+import asyncio
+import os
+
+from blind_watermark import WaterMark
+from blind_watermark.aio import Engine
+
+os.chdir(os.path.dirname(__file__))
+
+with open('pic/ori_img.jpeg', 'rb') as f:
+    ori_bytes = f.read()
+
+wm = '@guofei9987 开源万岁！'
+len_wm = len(WaterMark(password_wm=1).wm_to_bit(wm, mode='str'))  # 解水印需要用到长度
+
+# %% 不用 asyncio 时，WaterMark 也可以直接读写编码后的 bytes
+bwm = WaterMark(password_img=1, password_wm=1)
+bwm.read_img(data=ori_bytes)
+bwm.read_wm(wm, mode='str')
+embed_bytes = bwm.embed(return_bytes=True, format='.png')
+
+wm_extract = WaterMark(password_img=1, password_wm=1).extract(data=embed_bytes, wm_shape=len_wm, mode='str')
+print("从 bytes 的提取结果：", wm_extract)
+assert wm == wm_extract, '提取水印和原水印不一致'
+
+
+# %% asyncio：多个请求同时嵌入、提取，计算都在进程池中
+async def main():
+    engine = Engine(processes=2, max_concurrency=4)
+    try:
+        users = ['user{}'.format(i) for i in range(4)]
+        embedded = await asyncio.gather(*[engine.embed(ori_bytes, user, mode='str', password_wm=1, password_img=1)
+                                          for user in users])
+        assert all(isinstance(data, bytes) for data in embedded), '返回的不是编码后的图片'
+        len_user = len(WaterMark(password_wm=1).wm_to_bit(users[0], mode='str'))
+        extracted = await asyncio.gather(*[engine.extract(data, len_user, mode='str', password_wm=1, password_img=1)
+                                           for data in embedded])
+        return users, extracted
+    finally:
+        engine.close()
+
+
+users, extracted = asyncio.run(main())
+for user, wm_extract in zip(users, extracted):
+    print(user, "的提取结果：", wm_extract)
+    assert user == wm_extract, '提取水印和原水印不一致'
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+demonstrate batch embedding with a journal: run again with the same journal, and finished jobs are skipped
+'''
+import json
+import os
+import shutil
+
+from blind_watermark import WaterMark
+from blind_watermark.batch import BatchEmbedder
+
+os.chdir(os.path.dirname(__file__))
+
+batch_dir = 'output/batch'
+shutil.rmtree(batch_dir, ignore_errors=True)
+journal = os.path.join(batch_dir, 'journal.jsonl')
+
+params = {'password_img': 1, 'password_wm': 1}
+users = ['user{}'.format(i) for i in range(6)]
+jobs = [{'src': 'pic/ori_img.jpeg', 'target': os.path.join(batch_dir, user + '.png'), 'wm': user, 'params': params}
+        for user in users]
+
+# %% 第一次运行：全部完成，每完成一批（chunk_size 个）写一次 journal
+with BatchEmbedder(journal=journal, processes=2, chunk_size=4) as embedder:
+    summary = embedder.run(jobs, callback=lambda result: print(result['status'], result['target']))
+print(summary)
+assert summary == {'total': 6, 'skipped': 0, 'done': 6, 'failed': []}, '批量嵌入没有全部完成'
+
+# %% 模拟中断后续跑：删掉一个输出，用同一个 journal 重新运行，只重做这一个
+os.remove(jobs[2]['target'])
+with BatchEmbedder(journal=journal, processes=2, chunk_size=4) as embedder:
+    summary = embedder.run(jobs)
+print(summary)
+assert summary == {'total': 6, 'skipped': 5, 'done': 1, 'failed': []}, '续跑时没有跳过已完成的任务'
+
+with open(journal, encoding='utf-8') as f:
+    records = [json.loads(line) for line in f]
+assert len(records) == 7 and all(record['status'] == 'done' for record in records), 'journal 与运行结果不一致'
+
+# %% 解水印
+len_wm = len(WaterMark(**params).wm_to_bit(users[0], mode='str'))
+for job in jobs:
+    wm_extract = WaterMark(**params).extract(job['target'], wm_shape=len_wm, mode='str')
+    print(job['target'], "的提取结果：", wm_extract)
+    assert wm_extract == job['wm'], '提取水印和原水印不一致'
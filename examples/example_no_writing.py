@@ -8,7 +8,7 @@ This may be useful if you want to use blind-watermark in another project.
 import blind_watermark
 from blind_watermark import WaterMark
 from blind_watermark import att
-from blind_watermark.recover import estimate_crop_parameters, recover_crop
+from blind_watermark.recover import estimate_crop_parameters, estimate_originals, recover_crop, TemplateMatcher
 import cv2
 import numpy as np
 import os
@@ -77,6 +77,21 @@ wm_extract = bwm1.extract(embed_img=img_recover, wm_shape=len_wm, mode='str')
 print("截屏攻击，不知道攻击参数。提取结果：", wm_extract)
 assert wm == wm_extract, '提取水印和原水印不一致'
 
+# %% 同一张原图推测多个截图时共用 TemplateMatcher；默认的金字塔搜索与逐个 scale 的线性搜索（levels=0）结果一致
+matcher = TemplateMatcher(embed_img)
+loc_linear, _, score_linear, scale_linear = matcher.estimate(img_attacked, scale=(0.5, 2), search_num=200, levels=0)
+loc_pyramid, _, score_pyramid, scale_pyramid = matcher.estimate(img_attacked, scale=(0.5, 2), search_num=200)
+print(f'linear search: {loc_linear}, scale={scale_linear}, score={score_linear}')
+print(f'pyramid search: {loc_pyramid}, scale={scale_pyramid}, score={score_pyramid}')
+assert max(abs(a - b) for a, b in zip(loc_linear, loc_pyramid)) <= 2, '金字塔搜索的位置与线性搜索不一致'
+assert abs(scale_linear - scale_pyramid) < 0.01, '金字塔搜索的缩放比例与线性搜索不一致'
+
+# 不知道截图来自哪张原图：在多张原图中分别推测，分数最高的就是
+results = estimate_originals(img_attacked, [cv2.flip(embed_img, 1), embed_img], scale=(0.5, 2), search_num=200)
+best = max(range(len(results)), key=lambda i: results[i][2])
+print(f'estimate_originals: best={best}, scores={[round(float(result[2]), 4) for result in results]}')
+assert best == 1 and results[best][0] == loc_pyramid, '没有找到截图所在的原图'
+
 # %%裁剪攻击1 = 裁剪 + 不做缩放 + 知道攻击参数
 loc_r = ((0.1, 0.2), (0.5, 0.5))
 x1, y1, x2, y2 = int(w * loc_r[0][0]), int(h * loc_r[0][1]), int(w * loc_r[1][0]), int(h * loc_r[1][1])
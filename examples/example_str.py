@@ -5,6 +5,7 @@ import numpy as np
 from blind_watermark import WaterMark
 from blind_watermark import att
 from blind_watermark.recover import estimate_crop_parameters, recover_crop
+from blind_watermark.verify import Verifier
 import cv2
 import os
 
@@ -29,6 +30,22 @@ print("不攻击的提取结果：", wm_extract)
 
 assert wm == wm_extract, '提取水印和原水印不一致'
 
+# %% 原始像素的 .npy 文件：以 memmap 读入，分条嵌入，逐条写入输出的 .npy，不整张读入内存
+np.save('output/ori_img.npy', cv2.imread('pic/ori_img.jpeg'))
+bwm = WaterMark(password_img=1, password_wm=1)
+bwm.read_img('output/ori_img.npy')
+bwm.read_wm(wm, mode='str')
+bwm.embed(out='output/embedded.npy')
+assert np.array_equal(np.load('output/embedded.npy'), cv2.imread('output/embedded.png')), '.npy 与 png 的嵌入结果不一致'
+
+bwm1 = WaterMark(password_img=1, password_wm=1)
+wm_extract = bwm1.extract('output/embedded.npy', wm_shape=len_wm, mode='str')
+print("从 .npy 文件的提取结果：", wm_extract)
+assert wm == wm_extract, '提取水印和原水印不一致'
+
+wm_extract, _ = bwm1.extract_stream('output/embedded.npy', wm_shape=len_wm, mode='str')
+assert wm == wm_extract, '提取水印和原水印不一致'
+
 # %%截屏攻击1 = 裁剪攻击 + 缩放攻击 + 知道攻击参数（之后按照参数还原）
 
 loc_r = ((0.1, 0.1), (0.5, 0.5))
@@ -164,3 +181,12 @@ wm_extract = bwm1.extract('output/亮度攻击_还原.png', wm_shape=len_wm, mod
 
 print("亮度攻击后的提取结果：", wm_extract)
 assert np.all(wm == wm_extract), '提取水印和原水印不一致'
+
+# %% 一次验证一组攻击：在内存中攻击，用进程池并行提取，给出每种攻击的误码率
+wm_bit = np.array(list(bin(int(wm.encode('utf-8').hex(), base=16))[2:])) == '1'  # 与 read_wm(wm, mode='str') 相同，未加密
+with Verifier(processes=2) as verifier:
+    report = verifier.verify(cv2.imread('output/embedded.png'), wm_bit, password_wm=1, password_img=1)
+for item in report:
+    print("验证 {attack}：误码率 {ber}，耗时 {seconds:.2f}s".format(**item))
+    assert item['error'] is None, item['error']
+    assert item['ber'] == 0, '{attack} 攻击后提取水印和原水印不一致'.format(**item)
@@ -34,6 +34,7 @@ setup(name='blind_watermark',
       zip_safe=False,
       entry_points={
           'console_scripts': [
-              'blind_watermark = blind_watermark.cli_tools:main'
+              'blind_watermark = blind_watermark.cli_tools:main',
+              'blind_watermark_bench = blind_watermark.bench:main'
           ]
       })